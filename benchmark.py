@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+# nucleotides by their 2-bit code, and the code of the complement of each
+bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+complement_codes = np.array([3, 2, 1, 0], dtype=np.uint8)
+# the metrics compared against the baseline, with the direction that is better
+metrics = {"reads_per_s": "higher", "startup_s": "lower", "peak_rss_mb": "lower"}
+
+
+def random_codes(rng, shape):
+    """
+    Draws random nucleotides.
+    :param rng: numpy random generator
+    :param shape: shape of the array
+    :return: array of 2-bit nucleotide codes
+    """
+    return rng.integers(0, 4, size=shape, dtype=np.uint8)
+
+
+def generate_library(path, num_guides, guide_length, dual_guide, revcomp_collisions, rng):
+    """
+    Writes a library of random guide sequences. A fraction of the guides are the reverse complement of another
+    guide, so with reverse complements counted the reads of these guides match both.
+    :param path: library file name
+    :param num_guides: number of guides (or guide pairs)
+    :param guide_length: length of the guides
+    :param dual_guide: generate a second guide for each library entry
+    :param revcomp_collisions: fraction of guides that are the reverse complement of another guide
+    :param rng: numpy random generator
+    :return: array of the 2-bit codes of the guides, and of the second guides for dual guide libraries
+    """
+    guides = random_codes(rng, (num_guides, guide_length))
+    collisions = rng.random(num_guides) < revcomp_collisions
+    partners = rng.integers(0, num_guides, size=num_guides)
+    guides[collisions] = complement_codes[guides[partners[collisions], ::-1]]
+    guides2 = random_codes(rng, (num_guides, guide_length)) if dual_guide else None
+    with open(path, "w") as fh:
+        fh.write("CODE\tGENES\tSEQ" + ("\tSEQ2" if dual_guide else "") + "\n")
+        for i in range(num_guides):
+            fields = [f"GUIDE_{i}", f"GENE_{i // 4}", bases[guides[i]].tobytes().decode()]
+            if dual_guide:
+                fields.append(bases[guides2[i]].tobytes().decode())
+            fh.write("\t".join(fields) + "\n")
+    return guides, guides2
+
+
+def generate_reads(guides, origins, read_length, guide_offset, error_rate, rng):
+    """
+    Draws reads with a guide at a fixed position, random flanks and sequencing errors.
+    :param guides: array of the 2-bit codes of the guides
+    :param origins: array of the guide in each read, -1 for none
+    :param read_length: length of the reads
+    :param guide_offset: position of the guide in the reads
+    :param error_rate: probability of a substitution at each base
+    :param rng: numpy random generator
+    :return: array of the 2-bit codes of the reads
+    """
+    reads = random_codes(rng, (len(origins), read_length))
+    hits = np.flatnonzero(origins >= 0)
+    reads[hits, guide_offset:guide_offset + guides.shape[1]] = guides[origins[hits]]
+    errors = rng.random(reads.shape) < error_rate
+    reads[errors] = (reads[errors] + rng.integers(1, 4, size=np.count_nonzero(errors), dtype=np.uint8)) % 4
+    return reads
+
+
+def write_fastq(path, reads):
+    """
+    Writes reads as a gzip compressed FASTQ file, with the same file content for the same reads.
+    :param path: FASTQ file name
+    :param reads: array of the 2-bit codes of the reads
+    """
+    quality = b"I" * reads.shape[1]
+    with gzip.GzipFile(path, "wb", compresslevel=1, mtime=0) as fh:
+        for start in range(0, len(reads), 100000):
+            chunk = bases[reads[start:start + 100000]]
+            fh.write(b"".join(b"@read_%d\n%s\n+\n%s\n" % (start + i, seq.tobytes(), quality)
+                              for i, seq in enumerate(chunk)))
+
+
+def generate_data(work_dir, mode, args):
+    """
+    Writes a synthetic library and reads for one mode.
+    :param work_dir: directory to write the files to
+    :param mode: single or dual
+    :param args: parsed command line arguments
+    :return: library file name and the count.py options reading the reads
+    """
+    rng = np.random.default_rng(int(args.seed))
+    dual_guide = mode == "dual"
+    library = os.path.join(work_dir, f"{mode}_library.tsv")
+    guides, guides2 = generate_library(library, int(args.guides), int(args.guide_length), dual_guide,
+                                       float(args.revcomp_collisions), rng)
+    num_reads = int(args.reads)
+    origins = np.where(rng.random(num_reads) < float(args.hit_rate),
+                       rng.integers(0, len(guides), size=num_reads), -1)
+    settings = (int(args.read_length), int(args.guide_offset), float(args.error_rate), rng)
+    reads = generate_reads(guides, origins, *settings)
+    # duplicate reads (or read pairs) are copies of other reads, including their sequencing errors
+    duplicates = np.flatnonzero(rng.random(num_reads) < float(args.duplication))
+    copies = rng.integers(0, num_reads, size=len(duplicates))
+    reads[duplicates] = reads[copies]
+    if not dual_guide:
+        fastq = os.path.join(work_dir, f"{mode}.fq.gz")
+        write_fastq(fastq, reads)
+        return library, ["--fastq", fastq]
+    # the second reads carry the second guide of the same library entry
+    reads2 = generate_reads(guides2, origins, *settings)
+    reads2[duplicates] = reads2[copies]
+    r1 = os.path.join(work_dir, f"{mode}_r1.fq.gz")
+    r2 = os.path.join(work_dir, f"{mode}_r2.fq.gz")
+    write_fastq(r1, reads)
+    write_fastq(r2, reads2)
+    return library, ["--r1", r1, "--r2", r2]
+
+
+def run_count(options):
+    """
+    Runs count.py and measures it.
+    :param options: count.py command line options
+    :return: wall clock time in seconds and the peak resident set size of the largest of count.py and its worker
+    processes in MB
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "count.py")] + options
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    # wait4 gives the resource usage of this run alone, including the worker processes it waited for
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.stderr.close()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError(f"count.py failed with exit code {process.returncode}: " + stderr.decode()[-2000:])
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak_rss = usage.ru_maxrss / (1 << 20 if platform.system() == "Darwin" else 1 << 10)
+    return wall, peak_rss
+
+
+def run_benchmarks(work_dir, args):
+    """
+    Runs count.py on the synthetic data for all combinations of the swept settings.
+    :param work_dir: directory of the synthetic data
+    :param args: parsed command line arguments
+    :return: list of results, one dictionary per combination
+    """
+    results = []
+    for mode in args.modes.split(","):
+        logging.info(f"benchmark.py Generating {mode} guide data")
+        library, inputs = generate_data(work_dir, mode, args)
+        empty = os.path.join(work_dir, "empty.fq.gz")
+        write_fastq(empty, np.zeros((0, 1), dtype=np.uint8))
+        empty_inputs = ["--fastq", empty] if mode == "single" else ["--r1", empty, "--r2", empty]
+        out = os.path.join(work_dir, f"{mode}.count")
+        for engine in args.engines.split(","):
+            for processes in args.processes.split(","):
+                options = ["--lib", library, "--out", out, "--engine", engine, "--processes", processes]
+                if mode == "dual":
+                    options.append("--dual_guide")
+                # startup: loading the library and starting the workers, measured on an empty input
+                startup, _ = run_count(options + empty_inputs)
+                for block_size in args.block_size.split(","):
+                    wall, peak_rss = run_count(options + inputs + ["--block_size", block_size])
+                    result = {"mode": mode, "engine": engine, "processes": int(processes),
+                              "block_size": int(block_size), "reads": int(args.reads), "wall_s": round(wall, 3),
+                              "startup_s": round(startup, 3), "reads_per_s": round(int(args.reads) / wall, 1),
+                              "peak_rss_mb": round(peak_rss, 1)}
+                    logging.info("benchmark.py " + " ".join(f"{key}={value}" for key, value in result.items()))
+                    results.append(result)
+    return results
+
+
+def result_key(result):
+    return result["mode"], result["engine"], result["processes"], result["block_size"]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results against a baseline.
+    :param results: list of results, see run_benchmarks
+    :param baseline: list of baseline results
+    :param tolerance: relative change of a metric that is tolerated before it counts as a regression
+    :return: list of regressions as text
+    """
+    baseline = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        for metric, better in metrics.items():
+            if not before[metric]:
+                continue
+            ratio = result[metric] / before[metric]
+            worse = ratio < 1 - tolerance if better == "higher" else ratio > 1 + tolerance
+            line = (" ".join(str(value) for value in result_key(result))
+                    + f" {metric}: {before[metric]} -> {result[metric]} ({ratio:.2f}x)")
+            logging.info("benchmark.py " + line + (" REGRESSION" if worse else ""))
+            if worse:
+                regressions.append(line)
+    return regressions
+
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="count-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = run_benchmarks(work_dir, args)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+    settings = {key: getattr(args, key) for key in ["guides", "guide_length", "revcomp_collisions", "reads",
+                                                    "read_length", "guide_offset", "hit_rate", "duplication",
+                                                    "error_rate", "seed"]}
+    report = {"settings": settings, "python": platform.python_version(), "machine": platform.machine(),
+              "cpus": os.cpu_count(), "results": results}
+    with open(args.out, "w") as fh:
+        json.dump(report, fh, indent=2)
+    logging.info("benchmark.py Results written to: " + args.out)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline["settings"] != settings:
+            logging.warning("benchmark.py The baseline was run with other data settings: " +
+                            json.dumps(baseline["settings"]))
+        regressions = compare(results, baseline["results"], float(args.tolerance))
+        if regressions:
+            logging.error("benchmark.py Regressions against the baseline:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Benchmark count.py on synthetic libraries and reads.')
+    parser.add_argument('--out', help='JSON file to write the results to.', required=True)
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against; exits with status 1 if'
+                                           ' a metric got worse by more than the tolerance.')
+    parser.add_argument('--tolerance', help='Relative change of reads/s, startup time or peak RSS tolerated when'
+                                            ' comparing against the baseline [default: 0.1].', default=0.1)
+    parser.add_argument('--modes', help='Comma delimited library modes: single, dual [default: single,dual].',
+                        default="single,dual")
+    parser.add_argument('--engines', help='Comma delimited count.py engines [default: aho-corasick].',
+                        default="aho-corasick")
+    parser.add_argument('--processes', help='Comma delimited numbers of count.py processes [default: 1,4].',
+                        default="1,4")
+    parser.add_argument('--block_size', help='Comma delimited count.py block sizes [default: 25000,100000].',
+                        default="25000,100000")
+    parser.add_argument('--guides', help='Number of guides (or guide pairs) in the library [default: 100000].',
+                        default=100000)
+    parser.add_argument('--guide_length', help='Length of the guides [default: 20].', default=20)
+    parser.add_argument('--revcomp_collisions', help='Fraction of guides that are the reverse complement of another'
+                                                     ' guide [default: 0.001].', default=0.001)
+    parser.add_argument('--reads', help='Number of reads (or read pairs) [default: 1000000].', default=1000000)
+    parser.add_argument('--read_length', help='Length of the reads [default: 50].', default=50)
+    parser.add_argument('--guide_offset', help='Position of the guides in the reads [default: 23].', default=23)
+    parser.add_argument('--hit_rate', help='Fraction of reads containing a guide [default: 0.8].', default=0.8)
+    parser.add_argument('--duplication', help='Fraction of reads that are copies of another read [default: 0.3].',
+                        default=0.3)
+    parser.add_argument('--error_rate', help='Probability of a sequencing error at each base [default: 0.001].',
+                        default=0.001)
+    parser.add_argument('--seed', help='Seed of the random generator [default: 1].', default=1)
+    parser.add_argument('--work_dir', help='Directory to keep the synthetic data in [default: a temporary'
+                                           ' directory].')
+    args = parser.parse_args()
+    if int(args.guide_offset) + int(args.guide_length) > int(args.read_length):
+        parser.error('the guides must fit into the reads: --guide_offset + --guide_length > --read_length')
+    main(args)
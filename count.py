@@ -6,38 +6,1270 @@ Single guide counting : counts exact matches of guides located in an input fastq
 
 Dual guide counting : counts exact matches of two guides located in the same row position in two input fastq files.
 """
-import pandas as pd
 import numpy as np
-import ahocorasick, fileinput, argparse, logging
-from operator import itemgetter
+import ahocorasick, fileinput, argparse, logging, csv
+from itertools import islice, chain, repeat, tee
+from collections import Counter
+from functools import partial
 import concurrent.futures
+import gzip, struct, zlib
+import bisect, gc, hashlib, io, math, os, pickle, sys, tempfile
+import contextlib, json, resource, time
 import platform
 import multiprocessing
-
-logging.basicConfig(
-    format='%(asctime)s %(levelname)-8s %(message)s',
-    level=logging.INFO,
-    datefmt='%Y-%m-%d %H:%M:%S')
+from multiprocessing import shared_memory
+import mmap
 
 version = '1.0.0'
-auto = ahocorasick.Automaton()
-auto2 = ahocorasick.Automaton()
-temp_output = None
-multi_matches = 0
-unique_matches = 0
-mismatching_pairs = 0
+# size of the decompressed chunks in which FASTQ files are read
+fastq_chunk_size = 1 << 22
+# number of reads per block of --block_size, and per search of GuideCounter
+default_block_size = 25000
+# increase when the content of compiled library indexes changes, so that old index files are not used
+index_format = 4
+# 2-bit codes of the nucleotides, 4 for anything else (matching is case sensitive like the automatons)
+base_codes = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate("ACGT"):
+    base_codes[ord(base)] = code
+# number of leading bits of the encoded guide sequences in the prefilter bitmaps of the numpy engine
+prefilter_bits = 24
+auto = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+auto2 = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+# the automatons report pattern ids, ie indices of the distinct guide sequences, which map to the guide indices:
+# those of pattern id p are guides[starts[p]:starts[p + 1]] of the (starts, guides) arrays. The workers read them
+# through memoryviews, which unlike Python containers do not touch (and so copy) the memory shared with the parent.
+pattern_guides = ()
+# dual guide libraries: the rows of the pairs of R1 pattern id p are row_starts[p]:row_starts[p + 1] of the arrays
+# (row_starts, R2 pattern ids, starts, guides), sorted by R2 pattern id within a row, and the guide indices of pair
+# row r are guides[starts[r]:starts[r + 1]]; the pair of pattern ids is packed as id1 * pair_stride + id2 for the
+# numpy engine
+pair_table = ()
+pair_stride = 0
+# guide sequence -> pattern id, for looking up the guides at fixed read positions (--guide_offset)
+guide_lookup = {}
+guide_lookup2 = {}
+# guide length -> sequences one mismatch away from the guide sequences and their pattern ids (--max_mismatches 1)
+neighbours = {}
+neighbours2 = {}
+# numpy engine: guide length -> sorted encoded guide sequences, their pattern ids and a prefilter bitmap of their
+# leading bits; the guide indices of each pattern id and the dual guide pair table as flat arrays
+kmers = {}
+kmers2 = {}
+guide_arrays = ()
+pair_arrays = ()
+# --orientation auto counts the guides in one orientation only when at most this fraction of the sampled reads with
+# a match have a guide in the other orientation
+orientation_tolerance = 0.01
+# --autotune measures the throughput of the reader and of the workers every autotune_seconds and sizes the blocks so
+# that a worker takes about autotune_block_seconds for one, within autotune_block_sizes
+autotune_seconds = 2.0
+autotune_block_seconds = 0.25
+autotune_block_sizes = (1000, 250000)
+# --preview draws this many multinomial resamples of the counts for the intervals of the count distribution measures
+preview_resamples = 20
+# the match counters reported for every sample
+counter_names = ["unique_matches", "multi_matches", "mismatching_pairs", "rescued_matches"]
+# timings and throughput of the run, written with --stats_json
+run_stats = {}
+# how long it took this worker process to install the library index
+worker_startup = 0.0
+# the row of this worker process in the count arrays of the samples, which the workers add the counts of their blocks
+# to, and the (name of the shared memory, shared memory, row) of the sample being counted
+worker_slot = 0
+worker_counts = (None, None, None)
+# with --autotune, the (condition, shared number of busy workers, shared number of workers that may be busy) that cap
+# the number of workers searching a block at a time, see busy_worker
+worker_limit = None
+# the (path, mmap) of the input file and the slot -> (name, shared memory) of the ring the workers read blocks from
+input_map = (None, None)
+ring_buffers = {}
+# the index whose tables are installed in the globals above when counting in this process, see GuideCounter
+installed_index = None
 
 
-def process_result(future):
+@contextlib.contextmanager
+def timed_phase(name):
+    """
+    Adds the wall clock and CPU time spent in a block of code to a phase of the run statistics.
+    :param name: name of the phase
     """
-    This is a callback function that processes the results coming from completion of forked processors.
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        phase = run_stats.setdefault("phases", {}).setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0})
+        phase["wall_s"] += time.perf_counter() - wall
+        phase["cpu_s"] += time.process_time() - cpu
+
+
+def process_result(totals, future, unmatched_size=0):
+    """
+    Adds the match counters coming from completion of a block in a worker process to the totals of its sample; the
+    worker has added the counts of the block to its row of the sample's count arrays, see count_arrays.
+    :param totals: counts and match counters of the sample
     :param future: future object(with results) from the forked process
+    :param unmatched_size: number of unmatched reads kept track of (--unmatched), see merge_unmatched
+    """
+    started = time.perf_counter()
+    result = future.result()
+    for name in counter_names:
+        totals[name] += result[name]
+    if "sample_reads" in result:
+        totals["sample_reads"] += result["sample_reads"]
+    if "unmatched" in result:
+        totals["unmatched"] = merge_unmatched(totals.get("unmatched", ({}, 0)), result["unmatched"], unmatched_size)
+    pid, startup, busy, cpu = result["worker"]
+    worker = run_stats.setdefault("workers", {}).setdefault(pid, {"blocks": 0, "busy_s": 0.0, "cpu_s": 0.0,
+                                                                  "startup_s": startup})
+    worker["blocks"] += 1
+    worker["busy_s"] += busy
+    worker["cpu_s"] += cpu
+    run_stats["merge_s"] = run_stats.get("merge_s", 0.0) + time.perf_counter() - started
+
+
+@contextlib.contextmanager
+def busy_worker(limit):
+    """
+    Makes a worker process wait until fewer workers are busy than --autotune allows, and counts it as busy meanwhile.
+    :param limit: (condition, shared number of busy workers, shared number of workers that may be busy), or None
+    """
+    if limit is None:
+        yield
+        return
+    condition, busy, active = limit
+    with condition:
+        condition.wait_for(lambda: busy.value < active.value)
+        busy.value += 1
+    try:
+        yield
+    finally:
+        with condition:
+            busy.value -= 1
+            condition.notify_all()
+
+
+def timed_search(search, counts, block=None, barcodes=None, **input):
+    """
+    Runs a search function on a block of reads in a worker process and adds the counts to the worker's row of the
+    count arrays of the sample. Returns the match counters, with the worker's process id, startup time and the wall
+    clock and CPU time of the search.
+    :param search: exec_fragment_search or exec_kmer_search
+    :param counts: name of the shared memory of the count arrays of the sample, see count_arrays
+    :param block: block of unparsed reads, see read_raw_block, instead of the data_lines of the search
+    :param barcodes: barcode sheet to demultiplex the reads with, see demultiplex
+    :param input: arguments of the search function
+    """
+    global worker_counts
+    with busy_worker(worker_limit):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if block is not None:
+            input["data_lines"] = read_raw_block(block)
+        result = search(**input) if barcodes is None else demultiplex(search, barcodes, **input)
+        if worker_counts[0] != counts:
+            memory = worker_counts[1]
+            worker_counts = (None, None, None)
+            if memory is not None:
+                memory.close()
+            memory = shared_memory.SharedMemory(name=counts)
+            size = input["num_guides"] * (1 if barcodes is None else len(barcodes["samples"]) + 1)
+            worker_counts = (counts, memory, np.ndarray(size, dtype=np.int32, buffer=memory.buf,
+                                                        offset=worker_slot * size * 4))
+        add_counts(worker_counts[2], result.pop("output"))
+        result["worker"] = (os.getpid(), worker_startup, time.perf_counter() - wall, time.process_time() - cpu)
+    return result
+
+
+def count_arrays(processes, size):
+    """
+    Creates the count arrays of a sample in shared memory: one row per worker process, so that the workers add up
+    the counts of their blocks without sending them back, see timed_search. The counts are 32 bit, to halve the memory
+    of large libraries: they are reduced before a row could overflow, see count_samples.
+    :param processes: number of worker processes
+    :param size: number of counts of the sample: the number of guides, times the number of rows when demultiplexing
+    :return: (SharedMemory, processes x size array)
+    """
+    memory = shared_memory.SharedMemory(create=True, size=max(processes * size * 4, 1))
+    counts = np.ndarray((processes, size), dtype=np.int32, buffer=memory.buf)
+    counts[:] = 0
+    return memory, counts
+
+
+def reduce_counts(totals, counts, release=True):
+    """
+    Adds the rows of the count arrays of a sample to its totals, once none of its blocks are being processed.
+    :param totals: counts and match counters of the sample
+    :param counts: (SharedMemory, count arrays), see count_arrays
+    :param release: unlink the shared memory, otherwise the arrays are reset to zero
+    """
+    memory, arrays = counts
+    totals["output"] += arrays.sum(axis=0, dtype=np.int64).reshape(totals["output"].shape)
+    arrays[:] = 0
+    if release:
+        del arrays, counts
+        memory.close()
+        memory.unlink()
+
+
+def cpu_limit():
+    """
+    :return: number of CPUs this process may use: those it may run on, capped by the CPU quota of its cgroup, eg the
+    --cpus of a container
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:  # cgroup v2: "quota period", or "max period" without a quota
+        with open("/sys/fs/cgroup/cpu.max") as fh:
+            quota, period = fh.read().split()
+    except OSError:
+        try:  # cgroup v1: a quota of -1 without a quota
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as fh, \
+                    open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as fh2:
+                quota, period = fh.read().strip(), fh2.read().strip()
+        except OSError:
+            quota, period = "max", "1"
+    if quota not in ("max", "-1"):
+        cpus = min(cpus, max(1, int(quota) // int(period)))
+    return cpus
+
+
+def tune_settings(reader, worker, processes):
+    """
+    Chooses the number of blocks processed at a time and the block size from the measured throughput (--autotune):
+    as many busy workers as it takes to keep up with the reader, and blocks taking each about autotune_block_seconds.
+    :param reader: reads per second the main process supplies when it does not wait for the workers
+    :param worker: reads per CPU second of a worker
+    :param processes: number of worker processes
+    :return: number of busy workers, block size
+    """
+    active = min(processes, max(1, math.ceil(reader / worker)))
+    low, high = autotune_block_sizes
+    return active, int(min(max(round(worker * autotune_block_seconds, -3), low), high))
+
+
+def init_worker(index, slots=None, limit=None):
+    """
+    Initializer of the worker processes, run once per worker of the pool. Installs the automatons and lookup tables
+    as the worker's module-level globals, so they are not sent along with every block of reads.
+    :param index: compiled library index, see compile_library, with the "kmers" and "kmers2" guide arrays of
+    compile_kmers for the numpy engine
+    :param slots: shared counter of the rows of the count arrays taken by the workers, see count_arrays; None when
+    counting in this process, see GuideCounter
+    :param limit: limit of the number of busy workers (--autotune), see busy_worker, or None
+    """
+    global auto, auto2, pattern_guides, pair_table, pair_stride, guide_lookup, guide_lookup2, neighbours, neighbours2
+    global kmers, kmers2, guide_arrays, pair_arrays, worker_startup, worker_slot, worker_limit
+    started = time.perf_counter()
+    worker_limit = limit
+    if slots is not None:
+        with slots.get_lock():
+            worker_slot = slots.value
+            slots.value += 1
+    auto = index["auto"]
+    auto2 = index["auto2"]
+    pattern_guides = tuple(memoryview(array) for array in index["guides"])
+    pair_table = tuple(memoryview(array) for array in index["pairs"])
+    pair_stride = len(index["lookup2"])
+    guide_lookup = index["lookup"]
+    guide_lookup2 = index["lookup2"]
+    neighbours = index["neighbours"]
+    neighbours2 = index["neighbours2"]
+    if "kmers" in index:
+        kmers = add_prefilters(index["kmers"])
+        kmers2 = add_prefilters(index["kmers2"])
+        guide_arrays = index["guides"]
+        pair_arrays = (index["pair_keys"],) + index["pairs"][2:]
+    worker_startup = time.perf_counter() - started
+
+
+def group_arrays(rows, values, num_rows):
+    """
+    Groups values by their rows into flat arrays, leaving out repeated values of a row.
+    :param rows: array of the row number of each value
+    :param values: array of values
+    :param num_rows: number of rows
+    :return: array of the start of each row in the flat array (with the end as last element) and the flat array of the
+    sorted values of each row (int32)
+    """
+    order = np.lexsort((values, rows))
+    rows = rows[order]
+    values = values[order]
+    distinct = np.r_[True, (rows[1:] != rows[:-1]) | (values[1:] != values[:-1])]
+    rows = rows[distinct]
+    starts = np.searchsorted(rows, np.arange(num_rows + 1)).astype(np.int64)
+    return starts, values[distinct].astype(np.int32)
+
+
+def add_prefilters(index):
+    """
+    Adds a bitmap of the leading bits of the encoded guide sequences to a guide array index, which rules out most
+    read windows before they are searched for in the sorted guide sequences.
+    :param index: dictionary of guide lengths to sorted encoded guide sequences and their pattern ids
+    :return: dictionary of guide lengths to the sorted encoded guide sequences, their pattern ids, the bitmap and the
+    shift of the encoded sequences giving their leading bits
+    """
+    prefiltered = {}
+    for length, (keys, pattern_ids) in index.items():
+        shift = np.uint64(max(2 * length - prefilter_bits, 0))
+        bitmap = np.zeros(1 << min(2 * length, prefilter_bits), dtype=bool)
+        bitmap[keys >> shift] = True
+        prefiltered[length] = (keys, pattern_ids, bitmap, shift)
+    return prefiltered
+
+
+def lookup_guides(seq, slots, lookup):
+    """
+    Looks up the sequences at fixed positions of a read in a dictionary of guide sequences.
+    :param seq: read sequence
+    :param slots: (start, length) positions of the guides in the reads
+    :param lookup: dictionary of guide sequences to pattern ids
+    :return: list of the pattern ids found, empty if there is no guide at any of the positions
+    """
+    pattern_ids = []
+    for start, length in slots:
+        pattern_id = lookup.get(seq[start:start + length])
+        if pattern_id is not None:
+            pattern_ids.append(pattern_id)
+    return pattern_ids
+
+
+def pair_guides(ids1, ids2):
+    """
+    Looks up the guides matching both reads of a pair by the pattern ids found in them, instead of intersecting sets.
+    :param ids1: pattern ids found in the first read
+    :param ids2: pattern ids found in the second read
+    :return: tuple of guide indices, empty for mismatching pairs
+    """
+    if len(ids1) == 1 and len(ids2) == 1:
+        return paired_guides(ids1[0], ids2[0])
+    # several guides in a read: collect the guides of all combinations
+    return tuple({idx for id1 in ids1 for id2 in ids2 for idx in paired_guides(id1, id2)})
+
+
+def paired_guides(id1, id2):
+    """
+    Looks up the guides of a pair of pattern ids in the pair table.
+    :param id1: pattern id found in the first read
+    :param id2: pattern id found in the second read
+    :return: guide indices, empty if no guide has this pair of guide sequences
+    """
+    row_starts, partners, starts, guides = pair_table
+    end = row_starts[id1 + 1]
+    row = bisect.bisect_left(partners, id2, row_starts[id1], end)
+    if row == end or partners[row] != id2:
+        return ()
+    return guides[starts[row]:starts[row + 1]]
+
+
+def add_hits(output, idxs, weight):
+    """
+    Counts a read matching several guides, each of them once.
+    :param output: dictionary of guide indices to the counts of a block
+    :param idxs: guide indices
+    :param weight: number of reads the read stands for
+    """
+    for idx in set(idxs):
+        output[idx] = output.get(idx, 0) + weight
+
+
+def sparse_counts(output, arrays=()):
+    """
+    :param output: dictionary of guide indices to the counts of a block
+    :param arrays: further (guide indices, counts) arrays, which may repeat guide indices
+    :return: the counts of the block as sparse (guide indices, counts) arrays without repeated guide indices
+    """
+    indices = np.fromiter(output.keys(), dtype=np.int64, count=len(output))
+    counts = np.fromiter(output.values(), dtype=np.int64, count=len(output))
+    if arrays:
+        indices, inverse = np.unique(np.concatenate([indices] + [array for array, _ in arrays]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([counts] + [array for _, array in arrays]),
+                             minlength=len(indices)).astype(np.int64)
+    return indices, counts
+
+
+def add_counts(array, counts):
+    """
+    Adds sparse counts to a count array: scattered into it when they touch few of its elements, otherwise as a whole.
+    :param array: count array
+    :param counts: (indices, counts) arrays without repeated indices, see sparse_counts
+    """
+    indices, values = counts
+    if len(indices) * 8 < len(array):
+        array[indices] += values
+    else:
+        array += np.bincount(indices, weights=values, minlength=len(array)).astype(array.dtype)
+
+
+def unmatched_pair(reads, ids1, ids2):
+    """
+    :param reads: R1 and R2 sequences of a read pair without a match
+    :param ids1: pattern ids found in R1
+    :param ids2: pattern ids found in R2
+    :return: the key of the pair in the report of unmatched reads: for each read the sorted pattern ids found in it,
+    or the read itself if none were found
+    """
+    return tuple(sorted(set(ids1))) or reads[0], tuple(sorted(set(ids2))) or reads[1]
+
+
+def guides_of(pattern_id):
+    """
+    :param pattern_id: pattern id reported by the automatons
+    :return: guide indices of the pattern id
+    """
+    starts, guides = pattern_guides
+    return guides[starts[pattern_id]:starts[pattern_id + 1]]
+
+
+def encode_kmers(seqs, length):
+    """
+    2-bit encodes all windows of the given length (up to 32) of a list of sequences. Windows containing anything other
+    than ACGT are left out.
+    :param seqs: list of sequences
+    :param length: window length
+    :return: array of the encoded windows (uint64) and array of the index of the sequence of each window
+    """
+    codes = base_codes[np.frombuffer("".join(seqs).encode("ascii", "replace"), dtype=np.uint8)]
+    count = len(codes) - length + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    # the windows of a length are put together from the windows of the powers of two it is made of, which takes
+    # about log2(length) array operations instead of length
+    windows = {1: codes.astype(np.uint64) & np.uint64(3)}
+    span = 1
+    while span * 2 <= length:
+        shorter = windows[span]
+        windows[span * 2] = (shorter[:-span] << np.uint64(2 * span)) | shorter[span:]
+        span *= 2
+    keys = None
+    done = 0
+    while done < length:
+        span = 1 << (length - done).bit_length() - 1
+        if keys is None:
+            keys = windows[span]
+        else:
+            keys = (keys[:len(codes) - done - span + 1] << np.uint64(2 * span)) | windows[span][done:]
+        done += span
+    # windows must not contain anything other than ACGT, or span two sequences
+    invalid = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes > 3, out=invalid[1:])
+    owners = np.repeat(np.arange(len(seqs)), np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)))
+    valid = (invalid[length:] == invalid[:count]) & (owners[:count] == owners[length - 1:])
+    return keys[valid], owners[:count][valid]
+
+
+def kmer_hits(seqs, index):
+    """
+    Finds the guide sequences in all windows of the reads at once (--engine numpy).
+    :param seqs: read sequences
+    :param index: guide array index with prefilters, see add_prefilters
+    :return: array of the index of the read of each match and array of the pattern ids of the matches
+    """
+    owners = []
+    pattern_ids = []
+    for length, (keys, ids, bitmap, shift) in index.items():
+        windows, window_owners = encode_kmers(seqs, length)
+        candidates = np.flatnonzero(bitmap[windows >> shift])
+        windows = windows[candidates]
+        positions = np.minimum(np.searchsorted(keys, windows), len(keys) - 1)
+        hits = keys[positions] == windows
+        owners.append(window_owners[candidates[hits]])
+        pattern_ids.append(ids[positions[hits]])
+    if not owners:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(owners), np.concatenate(pattern_ids).astype(np.int64)
+
+
+def expand(starts, values, rows, counts=None):
+    """
+    Looks up the values of rows of flat arrays, see group_arrays.
+    :param starts: array of the start of each row in the flat array
+    :param values: flat array
+    :param rows: array of row numbers
+    :param counts: array of the number of values of each of the rows, computed if not given
+    :return: array of the values of the rows, one after the other, and array of the position in rows of each value
+    """
+    if counts is None:
+        counts = starts[rows + 1] - starts[rows]
+    origins = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(len(origins)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return values[starts[rows][origins] + offsets], origins
+
+
+def neighbour_ids(seqs, index):
+    """
+    Finds the guide sequences one mismatch away from any window of the reads.
+    :param seqs: read sequences
+    :param index: neighbour index, see compile_neighbours
+    :return: list of the pattern ids found in each read, empty for reads without a match or with an ambiguous one
+    """
+    found = [set() for _ in seqs]
+    ambiguous = set()
+    for length, (keys, pattern_ids) in index.items():
+        windows, owners = encode_kmers(seqs, length)
+        positions = np.minimum(np.searchsorted(keys, windows), len(keys) - 1)
+        hits = keys[positions] == windows
+        for owner, pattern_id in zip(owners[hits].tolist(), pattern_ids[positions[hits]].tolist()):
+            if pattern_id < 0:
+                ambiguous.add(owner)
+            else:
+                found[owner].add(pattern_id)
+    return [[] if owner in ambiguous else list(ids) for owner, ids in enumerate(found)]
+
+
+def detect_guide_slots(seqs, automaton, guides, patterns, read="R1"):
+    """
+    Finds the dominant positions of the guides in a sample of reads, separately for guides found in forward and in
+    reverse complement orientation.
+    :param seqs: sample of read sequences
+    :param automaton: automaton of the guides
+    :param guides: array of the guide sequences (forward orientation, bytes) by guide index
+    :param patterns: arrays of the guide indices by pattern id, see pattern_guides
+    :param read: name of the read for logging
+    :return: list of (start, length) positions, at most one per orientation
+    """
+    starts, indices = patterns
+    positions = {"forward": Counter(), "reverse": Counter()}
+    for seq in seqs:
+        for end, pattern_id in automaton.iter(seq):
+            guide = guides[indices[starts[pattern_id]]].decode()
+            start = end - len(guide) + 1
+            orientation = "forward" if seq[start:end + 1] == guide else "reverse"
+            positions[orientation][(start, len(guide))] += 1
+    slots = []
+    for orientation, counts in positions.items():
+        if counts:
+            slot, hits = counts.most_common(1)[0]
+            logging.info(f"count.py Guide offset ({read}, {orientation}): {slot[0]}, length {slot[1]},"
+                         f" {hits} of {sum(counts.values())} sampled matches")
+            slots.append(slot)
+    return slots
+
+
+def detect_orientation(seqs, automaton, guides, patterns, read="R1"):
+    """
+    Finds the orientation of the guides in a sample of reads: forward or reverse when hardly any reads have a guide in
+    the other orientation (orientation_tolerance), otherwise both.
+    :param seqs: sample of read sequences
+    :param automaton: automaton of the guides in both orientations
+    :param guides: array of the guide sequences (forward orientation, bytes) by guide index
+    :param patterns: arrays of the guide indices by pattern id, see pattern_guides
+    :param read: name of the read for logging
+    :return: forward, reverse or both
+    """
+    starts, indices = patterns
+    reads = Counter()
+    for seq in seqs:
+        found = set()
+        for end, pattern_id in automaton.iter(seq):
+            guide = guides[indices[starts[pattern_id]]].decode()
+            start = end - len(guide) + 1
+            found.add("forward" if seq[start:end + 1] == guide else "reverse")
+        reads.update(found)
+        reads["matched"] += bool(found)
+    orientation = "both"
+    if reads["reverse"] <= orientation_tolerance * reads["matched"] < reads["forward"]:
+        orientation = "forward"
+    elif reads["forward"] <= orientation_tolerance * reads["matched"] < reads["reverse"]:
+        orientation = "reverse"
+    logging.info(f"count.py Orientation ({read}): {orientation}, {reads['forward']} forward and {reads['reverse']}"
+                 f" reverse complement matches in {reads['matched']} of {len(seqs)} sampled reads")
+    return orientation
+
+
+def read_blocks(lines, block_size):
+    """
+    Groups the input lines into blocks which are processed by the workers.
+    :param lines: iterable of input lines
+    :param block_size: maximum number of lines in a block
+    :return: generator of lists of lines
+    """
+    lines = iter(lines)
+    while True:
+        block = list(islice(lines, block_size))
+        if not block:
+            return
+        yield block
+
+
+def collapse_blocks(reads, block_size, max_distinct):
+    """
+    Groups the input reads into blocks of distinct reads and their multiplicities, so that each distinct read is
+    matched only once. Identical reads are counted in windows of the input which end once max_distinct different reads
+    have been seen (plus at most one block), which bounds the memory use. If the first window has few duplicates
+    collapsing is not worth it, and the remaining reads are passed on as they are.
+    :param reads: iterable of reads
+    :param block_size: maximum number of reads in a block
+    :param max_distinct: maximum number of distinct reads held in memory
+    :return: generator of (reads, multiplicities) blocks, multiplicities is None for blocks that are not collapsed
+    """
+    reads = iter(reads)
+    first_window = True
+    while True:
+        counts = Counter()
+        total = 0
+        while len(counts) < max_distinct:
+            chunk = list(islice(reads, max(block_size, max_distinct - len(counts))))
+            if not chunk:
+                break
+            counts.update(chunk)
+            total += len(chunk)
+        if not counts:
+            return
+        logging.info(f"count.py Collapsed {total} reads into {len(counts)} distinct reads")
+        distinct = list(counts)
+        multiplicities = list(counts.values())
+        for start in range(0, len(distinct), block_size):
+            yield distinct[start:start + block_size], multiplicities[start:start + block_size]
+        if len(counts) < max_distinct:  # end of input
+            return
+        if first_window and len(counts) > 0.8 * total:
+            logging.info("count.py Too few duplicate reads to collapse, counting the remaining reads one by one")
+            for block in read_blocks(reads, block_size):
+                yield block, None
+            return
+        first_window = False
+
+
+def is_bgzf(path):
+    """
+    Checks whether a file is BGZF compressed, ie a gzip file made of independently compressed blocks whose sizes
+    are stored in a "BC" extra field (as written by bgzip).
+    :param path: file path
+    :return: True for BGZF files
+    """
+    with open(path, "rb") as fh:
+        header = fh.read(18)
+    return len(header) == 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def read_bgzf_blocks(fh):
+    """
+    Splits a BGZF stream into its compressed blocks without decompressing them.
+    :param fh: binary file handle positioned at the start of a block
+    :return: generator of compressed blocks (bytes)
+    """
+    while True:
+        header = fh.read(18)
+        if len(header) < 18:
+            return
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        yield header + fh.read(block_size - 18)
+
+
+def inflate_bgzf_block(block):
+    """
+    Decompresses a single BGZF block. zlib releases the GIL, so blocks can be inflated in parallel threads.
+    :param block: compressed block including its header and trailer
+    :return: decompressed data
+    """
+    extra_length = struct.unpack("<H", block[10:12])[0]
+    return zlib.decompress(block[12 + extra_length:-8], wbits=-15)
+
+
+def bgzf_chunks(path, threads, offset=0):
+    """
+    Decompresses a BGZF file with a pool of threads, keeping the blocks in file order.
+    :param path: file path
+    :param threads: number of decompression threads
+    :param offset: position of the block to start from
+    :return: generator of decompressed chunks
+    """
+    blocks_per_chunk = max(1, fastq_chunk_size >> 16)
+    with open(path, "rb") as fh, concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        fh.seek(offset)
+        blocks = read_bgzf_blocks(fh)
+        while True:
+            batch = list(islice(blocks, blocks_per_chunk * threads))
+            if not batch:
+                return
+            yield b"".join(executor.map(inflate_bgzf_block, batch))
+
+
+def fastq_chunks(path, threads=1):
+    """
+    Reads a plain or gzip compressed FASTQ file in large decompressed chunks. BGZF files are decompressed block
+    parallel, other gzip files in a background thread if the isal package is available.
+    :param path: file path, files ending in .gz are decompressed
+    :param threads: number of decompression threads
+    :return: generator of chunks (bytes), not aligned to line ends
+    """
+    if not path.endswith(".gz"):
+        opener = partial(open, path, "rb")
+    elif is_bgzf(path):
+        yield from bgzf_chunks(path, threads)
+        return
+    else:
+        try:
+            from isal import igzip_threaded
+            opener = partial(igzip_threaded.open, path, "rb", threads=threads)
+        except ImportError:
+            opener = partial(gzip.open, path, "rb")
+    with opener() as fh:
+        yield from iter(partial(fh.read, fastq_chunk_size), b"")
+
+
+def fastq_sequences(chunks):
+    """
+    Extracts the sequence lines, ie the second line of every four, from the chunks of a FASTQ file.
+    :param chunks: iterable of chunks (bytes), not necessarily aligned to line ends
+    :return: generator of lists of sequences, one list per chunk
+    """
+    remainder = b""
+    # position within its record of the first line of the next chunk
+    phase = 0
+    for chunk in chunks:
+        chunk = remainder + chunk
+        end = chunk.rfind(b"\n") + 1
+        remainder = chunk[end:]
+        if end == 0:
+            continue
+        lines = chunk[:end - 1].decode().split("\n")
+        yield lines[(1 - phase) % 4::4]
+        phase = (phase + len(lines)) % 4
+    if remainder and phase == 1:  # last sequence line without a newline
+        yield [remainder.decode()]
+
+
+def read_fastq(path, threads=1):
     """
-    global temp_output, multi_matches, unique_matches, mismatching_pairs
-    temp_output += future.result()["output"]
-    multi_matches += future.result()["multi_matches"]
-    unique_matches += future.result()["unique_matches"]
-    mismatching_pairs += future.result()["mismatching_pairs"]
+    Reads the sequences of a FASTQ file.
+    :param path: file path, files ending in .gz are decompressed
+    :param threads: number of decompression threads
+    :return: generator of sequences
+    """
+    for sequences in fastq_sequences(fastq_chunks(path, threads)):
+        yield from sequences
+
+
+def read_fastq_pairs(path1, path2, threads=1):
+    """
+    Reads the sequences of two paired FASTQ files in step.
+    :param path1: R1 file path
+    :param path2: R2 file path
+    :param threads: number of decompression threads per file
+    :return: generator of (R1 sequence, R2 sequence) tuples
+    """
+    return zip(read_fastq(path1, threads), read_fastq(path2, threads), strict=True)
+
+
+def open_reads(input=None, fastq=None, r1=None, r2=None, threads=1, index=None):
+    """
+    Opens the sequencing reads of a sample, given as exactly one of input, fastq or r1 and r2.
+    :param input: file name, plain or BGZF compressed, or - for stdin, with one nucleotide sequence (or separated
+    pair of sequences) per line
+    :param fastq: FASTQ file name
+    :param r1: R1 FASTQ file name of a pair
+    :param r2: R2 FASTQ file name of a pair
+    :param threads: number of decompression threads per FASTQ file
+    :param index: index read FASTQ file name of fastq or r1 and r2, for demultiplexing (--index_fastq)
+    :return: iterable of reads: lines for input, sequences for fastq and (R1, R2) tuples for r1/r2, with an index
+    file (read, index read sequence) tuples
+    """
+    if index:
+        return zip(open_reads(input, fastq, r1, r2, threads), read_fastq(index, threads), strict=True)
+    if fastq:
+        return read_fastq(fastq, threads)
+    if r1:
+        return read_fastq_pairs(r1, r2, threads)
+    if input != "-" and os.path.isfile(input) and is_bgzf(input):
+        return read_line_range(input, 1, 1, threads)
+    return fileinput.FileInput(input)
+
+
+def parse_shard(value):
+    """
+    Parses a --shard value.
+    :param value: shard number and number of shards as i/N, the shards are numbered from 1
+    :return: (shard number, number of shards) tuple
+    """
+    try:
+        shard, shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form i/N")
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError(f"shard {shard} is not between 1 and {shards}")
+    return shard, shards
+
+
+def bgzf_index(path):
+    """
+    Lists the BGZF blocks of a file from their headers and trailers, without decompressing them.
+    :param path: BGZF file path
+    :return: list of the compressed offsets of the blocks and list of their decompressed offsets, both ending with
+    the size of the file
+    """
+    offsets = [0]
+    data_offsets = [0]
+    with open(path, "rb") as fh:
+        while True:
+            header = fh.read(18)
+            if len(header) < 18:
+                return offsets, data_offsets
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            # the last 4 bytes of a block are the size of its decompressed data
+            fh.seek(block_size - 22, os.SEEK_CUR)
+            offsets.append(offsets[-1] + block_size)
+            data_offsets.append(data_offsets[-1] + struct.unpack("<I", fh.read(4))[0])
+
+
+def range_lines(chunks, position, start, end):
+    """
+    Extracts the lines starting within a byte range of a file, so that consecutive ranges get every line once.
+    :param chunks: iterable of chunks (bytes) of the file, or of its decompressed data, beginning before start
+    :param position: position of the first chunk in the file
+    :param start: start of the range
+    :param end: end of the range (exclusive)
+    :return: generator of lines, without their newlines
+    """
+    buffer = b""
+    # lines start at the beginning of the file and after each newline, so a line starts at start if the byte before
+    # it is a newline
+    skip = max(start - 1 - position, 0) if start else None
+    for chunk in chunks:
+        buffer += chunk
+        if skip is not None:
+            newline = buffer.find(b"\n", skip)
+            if newline < 0:
+                skip = max(skip - len(buffer), 0)
+                position += len(buffer)
+                buffer = b""
+                continue
+            position += newline + 1
+            buffer = buffer[newline + 1:]
+            skip = None
+        last = buffer.rfind(b"\n")
+        for line in buffer[:last + 1].split(b"\n")[:-1]:
+            if position >= end:
+                return
+            position += len(line) + 1
+            yield line.decode()
+        buffer = buffer[last + 1:]
+    if buffer and skip is None and position < end:  # last line without a newline
+        yield buffer.decode()
+
+
+def read_line_range(path, shard, shards, threads=1):
+    """
+    Reads the lines of one shard of a plain or BGZF compressed file with one sequence (or pair of sequences) per
+    line. The file is split into shards of equal numbers of (compressed) bytes, and each line belongs to the shard it
+    starts in; a BGZF block belongs to the shard its header is in.
+    :param path: file path
+    :param shard: shard number, from 1
+    :param shards: number of shards
+    :param threads: number of decompression threads for BGZF files
+    :return: generator of lines
+    """
+    size = os.path.getsize(path)
+    start = size * (shard - 1) // shards
+    end = size * shard // shards
+    if not is_bgzf(path):
+        with open(path, "rb") as fh:
+            position = max(start - 1, 0)
+            fh.seek(position)
+            yield from range_lines(iter(partial(fh.read, fastq_chunk_size), b""), position, start, end)
+        return
+    offsets, data_offsets = bgzf_index(path)
+    start = data_offsets[bisect.bisect_left(offsets, start)]
+    end = data_offsets[bisect.bisect_left(offsets, end)]
+    # decompress from the block with the byte before the range, which tells whether a line starts at its beginning
+    block = max(bisect.bisect_right(data_offsets, start - 1) - 1, 0)
+    yield from range_lines(bgzf_chunks(path, threads, offsets[block]), data_offsets[block], start, end)
+
+
+def interleave_shard(reads, block_size, shard, shards):
+    """
+    Picks the reads of one shard of an input that cannot be split by byte ranges, eg a FASTQ file: the reads are
+    read in blocks, which are dealt to the shards in turn.
+    :param reads: iterable of reads
+    :param block_size: number of reads in a block
+    :param shard: shard number, from 1
+    :param shards: number of shards
+    :return: generator of the reads of the shard
+    """
+    for number, block in enumerate(read_blocks(reads, block_size)):
+        if number % shards == shard - 1:
+            yield from block
+
+
+def read_shard(args):
+    """
+    Opens the reads of the --shard of the input given on the command line: byte ranges of a seekable --input file, or
+    interleaved blocks of reads of --fastq or --r1 and --r2.
+    :param args: parsed command line arguments
+    :return: iterable of reads, see open_reads
+    """
+    shard, shards = args.shard
+    threads = int(args.decompress_threads)
+    if args.input:
+        return read_line_range(args.input, shard, shards, threads)
+    reads = open_reads(fastq=args.fastq, r1=args.r1, r2=args.r2, threads=threads)
+    return interleave_shard(reads, int(args.block_size), shard, shards)
+
+
+def open_sample(source, args):
+    """
+    Opens the sequencing reads of a sample, or of the --shard of the input given on the command line.
+    :param source: input files of the sample, see open_reads
+    :param args: parsed command line arguments
+    :return: iterable of reads, see open_reads
+    """
+    if args.shard:
+        return read_shard(args)
+    return open_reads(**source, threads=int(args.decompress_threads))
+
+
+def line_start(fh, position):
+    """
+    :param fh: file opened in binary mode
+    :param position: position in the file
+    :return: position of the first line starting at or after position
+    """
+    if position == 0:
+        return 0
+    fh.seek(position - 1)
+    fh.readline()
+    return fh.tell()
+
+
+def read_region(fh, start, end):
+    """
+    Reads a byte range of a file in chunks.
+    :param fh: file opened in binary mode
+    :param start: start of the range
+    :param end: end of the range (exclusive)
+    :return: generator of chunks (bytes)
+    """
+    fh.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = fh.read(min(fastq_chunk_size, remaining))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        yield chunk
+
+
+def cut_records(chunks, lines_per_record, block_sizes):
+    """
+    Cuts a stream of chunks into blocks of records at line ends, without parsing the lines.
+    :param chunks: iterable of chunks (bytes), not aligned to line ends
+    :param lines_per_record: 1 for one read per line, 4 for FASTQ
+    :param block_sizes: iterable of the number of records of each block, taken when the block is started
+    :return: generator of (list of the pieces (bytes) of the block, number of records, position of the block in the
+    stream)
+    """
+    block_sizes = iter(block_sizes)
+    block_size = next(block_sizes)
+    lines_per_block = lines_per_record * block_size
+    pieces = []
+    # lines still missing from the current block, which starts at position
+    needed = lines_per_block
+    position = 0
+    for chunk in chunks:
+        ends = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+        start = 0
+        used = 0
+        while len(ends) - used >= needed:
+            used += needed
+            cut = int(ends[used - 1]) + 1
+            pieces.append(chunk[start:cut])
+            yield pieces, block_size, position
+            position += sum(map(len, pieces))
+            pieces = []
+            start = cut
+            block_size = next(block_sizes)
+            lines_per_block = lines_per_record * block_size
+            needed = lines_per_block
+        needed -= len(ends) - used
+        if start < len(chunk):
+            pieces.append(chunk[start:])
+    if pieces:
+        # the last line may lack its newline
+        lines = lines_per_block - needed + (not pieces[-1].endswith(b"\n"))
+        yield pieces, lines if lines_per_record == 1 else (lines + 2) // 4, position
+
+
+def skip_records(blocks, skip, lines_per_record):
+    """
+    Drops the first records of a stream of blocks, see cut_records.
+    :param blocks: iterable of (pieces, number of records, position) blocks
+    :param skip: number of records to drop
+    :param lines_per_record: 1 for one read per line, 4 for FASTQ
+    :return: generator of the remaining blocks
+    """
+    for pieces, records, position in blocks:
+        if skip >= records:
+            skip -= records
+            continue
+        if skip:
+            data = b"".join(pieces)
+            cut = int(np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)[skip * lines_per_record - 1]) + 1
+            pieces, records, position = [data[cut:]], records - skip, position + cut
+            skip = 0
+        yield pieces, records, position
+
+
+def record_blocks(chunks, lines_per_record, skip, args, block_sizes=None):
+    """
+    Cuts a stream of chunks into the blocks of --block_size records of this run: those of its --shard, if any, less
+    the first skip records.
+    :param chunks: iterable of chunks (bytes), not aligned to line ends
+    :param lines_per_record: 1 for one read per line, 4 for FASTQ
+    :param skip: number of records counted before a checkpoint
+    :param args: parsed command line arguments
+    :param block_sizes: iterable of the sizes of the blocks, instead of --block_size (--autotune)
+    :return: generator of blocks, see cut_records
+    """
+    blocks = cut_records(chunks, lines_per_record, block_sizes or repeat(int(args.block_size)))
+    if args.shard and not args.input:
+        # the same blocks as interleave_shard
+        shard, shards = args.shard
+        blocks = (block for number, block in enumerate(blocks) if number % shards == shard - 1)
+    return skip_records(blocks, skip, lines_per_record)
+
+
+def raw_blocks(source, skip, args, block_sizes=None):
+    """
+    Cuts the reads of a sample into blocks which the workers parse themselves, see read_raw_block: byte ranges of a
+    plain --input file, which the workers map into memory, or the bytes read from a pipe or decompressed from BGZF
+    --input or FASTQ files, which are passed to the workers through shared memory.
+    :param source: input files of the sample, see open_reads
+    :param skip: number of reads counted before a checkpoint
+    :param args: parsed command line arguments
+    :param block_sizes: iterable of the sizes of the blocks, see record_blocks
+    :return: generator of (block, number of reads): ("file", path, start, end) blocks or ("memory", list of the
+    pieces of each file, True for FASTQ, True if the last file is an index read FASTQ) blocks
+    """
+    threads = int(args.decompress_threads)
+    path = source["input"]
+    if path and path != "-" and os.path.isfile(path) and is_bgzf(path):
+        for pieces, reads, _ in record_blocks(bgzf_chunks(path, threads), 1, skip, args, block_sizes):
+            yield ("memory", [pieces], False, False), reads
+    elif path and path != "-" and os.path.isfile(path):
+        with open(path, "rb") as fh:
+            start, end = 0, os.path.getsize(path)
+            if args.shard:
+                shard, shards = args.shard
+                start, end = (line_start(fh, end * (shard - 1) // shards), line_start(fh, end * shard // shards))
+            for pieces, reads, position in record_blocks(read_region(fh, start, end), 1, skip, args, block_sizes):
+                yield ("file", path, start + position, start + position + sum(map(len, pieces))), reads
+    elif path:
+        fh = sys.stdin.buffer if path == "-" else open(path, "rb")
+        with fh:
+            for pieces, reads, _ in record_blocks(iter(partial(fh.read, fastq_chunk_size), b""), 1, skip, args,
+                                                  block_sizes):
+                yield ("memory", [pieces], False, False), reads
+    else:
+        paths = [source["fastq"]] if source["fastq"] else [source["r1"], source["r2"]]
+        if source.get("index"):
+            paths.append(source["index"])
+        # the files of a sample must be cut into blocks of the same sizes
+        sizes = None if block_sizes is None else tee(block_sizes, len(paths))
+        streams = [record_blocks(fastq_chunks(path, threads), 4, skip, args, sizes and sizes[number])
+                   for number, path in enumerate(paths)]
+        for blocks in zip(*streams, strict=True):
+            reads = blocks[0][1]
+            if any(block[1] != reads for block in blocks):
+                raise ValueError(f"{' and '.join(paths)} have different numbers of reads")
+            yield ("memory", [block[0] for block in blocks], True, bool(source.get("index"))), reads
+
+
+def fill_ring_slot(ring, slot, block):
+    """
+    Copies the bytes of a block into a slot of the ring of shared memory the workers read the blocks from. A slot
+    that is too small for the block is replaced by a larger one.
+    :param ring: list of shared memory blocks (SharedMemory or None), one per slot
+    :param slot: index of a free slot
+    :param block: ("memory", list of the pieces of each file, True for FASTQ, True with an index read) block, see
+    raw_blocks
+    :return: ("ring", slot, name of its shared memory, length of the data of each file, True for FASTQ, True with an
+    index read) block
+    """
+    _, files, fastq, index = block
+    size = sum(len(piece) for pieces in files for piece in pieces)
+    if ring[slot] is None or ring[slot].size < size:
+        if ring[slot] is not None:
+            ring[slot].close()
+            ring[slot].unlink()
+        ring[slot] = shared_memory.SharedMemory(create=True, size=max(size + size // 4, fastq_chunk_size))
+    buffer = ring[slot].buf
+    position = 0
+    lengths = []
+    for pieces in files:
+        start = position
+        for piece in pieces:
+            buffer[position:position + len(piece)] = piece
+            position += len(piece)
+        lengths.append(position - start)
+    return "ring", slot, ring[slot].name, lengths, fastq, index
+
+
+def parse_records(data, fastq):
+    """
+    :param data: text of whole records
+    :param fastq: True for FASTQ records, False for one read per line
+    :return: list of the sequences
+    """
+    lines = data.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines[1::4] if fastq else lines
+
+
+def read_raw_block(block):
+    """
+    Reads and parses a block of reads in a worker process, see raw_blocks and fill_ring_slot.
+    :param block: ("file", path, start, end) or ("ring", slot, name, lengths, fastq, index) block
+    :return: list of reads, see open_reads
+    """
+    global input_map
+    if block[0] == "file":
+        _, path, start, end = block
+        if input_map[0] != path:
+            with open(path, "rb") as fh:
+                input_map = (path, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+        return parse_records(input_map[1][start:end].decode(), False)
+    _, slot, name, lengths, fastq, index = block
+    if ring_buffers.get(slot, (None,))[0] != name:
+        if slot in ring_buffers:
+            ring_buffers.pop(slot)[1].close()
+        ring_buffers[slot] = (name, shared_memory.SharedMemory(name=name))
+    buffer = ring_buffers[slot][1].buf
+    reads = []
+    position = 0
+    for length in lengths:
+        reads.append(parse_records(str(buffer[position:position + length], "utf-8"), fastq))
+        position += length
+    index_reads = reads.pop() if index else None
+    reads = reads[0] if len(reads) == 1 else list(zip(*reads))
+    return reads if index_reads is None else list(zip(reads, index_reads))
+
+
+def read_sample_sheet(path, args):
+    """
+    Reads a tab delimited sample sheet with a header line. Each row names a sample in the "sample" column and its reads
+    in an "input" (one sequence per line), "fastq" or "r1" and "r2" column.
+    :param path: sample sheet file name
+    :param args: parsed command line arguments
+    :return: dictionary of sample names to their input files (see open_reads), in the order of the sheet
+    """
+    samples = {}
+    with open(path, newline="") as fh:
+        for row in csv.DictReader(fh, delimiter="\t"):
+            name = row["sample"]
+            if name in samples:
+                raise ValueError(f"Sample {name} is listed twice in {path}")
+            sources = {key: row.get(key) or None for key in ["input", "fastq", "r1", "r2"]}
+            if sum(bool(sources[key]) for key in ["input", "fastq", "r1"]) != 1 or \
+                    bool(sources["r1"]) != bool(sources["r2"]):
+                raise ValueError(f"Sample {name} in {path} needs an input, a fastq or an r1 and an r2 file")
+            if args.dual_guide and sources["fastq"] or not args.dual_guide and sources["r1"]:
+                raise ValueError(f"Sample {name} in {path}: use r1 and r2 for dual guide and fastq for single guide"
+                                 " libraries")
+            samples[name] = sources
+    return samples
+
+
+def read_barcodes(path, args):
+    """
+    Reads a tab delimited barcode sheet with a header line for demultiplexing (--barcodes). Each row gives a sample in
+    the "sample" column and its barcode in the "barcode" column, optionally with its 0-based "position" (default 0)
+    and the "read" it is in: R1 (default), R2 for dual guides, or I1 for the --index_fastq read.
+    :param path: barcode sheet file name
+    :param args: parsed command line arguments
+    :return: dictionary with the "samples" names in the order of the sheet, the barcode "lookups": list of (read,
+    position, length, dictionary of barcodes to sample numbers), and whether the reads come with an "index" read
+    """
+    samples = []
+    lookups = {}
+    with open(path, newline="") as fh:
+        for row in csv.DictReader(fh, delimiter="\t"):
+            name = row["sample"]
+            read = row.get("read") or "R1"
+            if read not in ("R1", "R2", "I1") or read == "R2" and not args.dual_guide or \
+                    read == "I1" and not args.index_fastq:
+                raise ValueError(f"Sample {name} in {path}: read must be R1, R2 for dual guides or I1 with"
+                                 " --index_fastq")
+            if name in samples:
+                raise ValueError(f"Sample {name} is listed twice in {path}")
+            barcode = row["barcode"]
+            lookup = lookups.setdefault((read, int(row.get("position") or 0), len(barcode)), {})
+            if barcode in lookup:
+                raise ValueError(f"Samples {samples[lookup[barcode]]} and {name} in {path} have the same barcode")
+            lookup[barcode] = len(samples)
+            samples.append(name)
+    return {"samples": samples, "lookups": [key + (lookup,) for key, lookup in lookups.items()],
+            "index": bool(args.index_fastq)}
+
+
+def barcode_samples(reads, barcodes, is_dual_guide, dual_guide_seq_sep):
+    """
+    Assigns reads to samples by their barcodes, see read_barcodes. A read is assigned to the sample of the first
+    barcode found at its position.
+    :param reads: list of reads, with an index read (read, index read sequence) tuples
+    :param barcodes: barcode sheet, see read_barcodes
+    :param is_dual_guide: the library contains dual guides
+    :param dual_guide_seq_sep: separator of the R1 and R2 sequences of lines of dual guide reads
+    :return: list of the sample number of each read, the number of samples for unassigned reads
+    """
+    unassigned = len(barcodes["samples"])
+    lookups = barcodes["lookups"]
+    has_index = barcodes["index"]
+    assigned = []
+    for read in reads:
+        index_read = None
+        if has_index:
+            read, index_read = read
+        if isinstance(read, tuple):
+            parts = {"R1": read[0], "R2": read[1]}
+        elif is_dual_guide:
+            parts = dict(zip(["R1", "R2"], read.strip().split(dual_guide_seq_sep)))
+        else:
+            parts = {"R1": read.strip()}
+        parts["I1"] = index_read
+        sample = unassigned
+        for part, position, length, lookup in lookups:
+            sample = lookup.get((parts.get(part) or "")[position:position + length], unassigned)
+            if sample != unassigned:
+                break
+        assigned.append(sample)
+    return assigned
+
+
+def demultiplex(search, barcodes, **input):
+    """
+    Counts the guides of a block of reads of several samples told apart by barcodes (--barcodes): the reads are
+    assigned to their samples, and the reads of each sample are searched separately.
+    :param search: exec_fragment_search or exec_kmer_search
+    :param barcodes: barcode sheet, see read_barcodes
+    :param input: arguments of the search function
+    :return: the results of the search with a row per sample and a last row for the unassigned reads: the sparse
+    "output" counts of the flattened count matrix, the arrays of match counters and of "sample_reads"
+    """
+    lines = input["data_lines"]
+    weights = input.get("weights")
+    assigned = barcode_samples(lines, barcodes, input["is_dual_guide"], input["dual_guide_seq_sep"])
+    if barcodes["index"]:
+        lines = [read for read, _ in lines]
+    rows = len(barcodes["samples"]) + 1
+    result = {"sample_reads": np.zeros(rows, dtype=int), **{name: np.zeros(rows, dtype=int) for name in counter_names}}
+    indices, counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    groups = {}
+    for read, sample in enumerate(assigned):
+        groups.setdefault(sample, []).append(read)
+    for sample, reads in groups.items():
+        sample_weights = None if weights is None else [weights[read] for read in reads]
+        sample_result = search(**dict(input, data_lines=[lines[read] for read in reads], weights=sample_weights))
+        indices.append(sample_result["output"][0] + sample * input["num_guides"])
+        counts.append(sample_result["output"][1])
+        for name in counter_names:
+            result[name][sample] = sample_result[name]
+        result["sample_reads"][sample] = len(reads) if weights is None else sum(sample_weights)
+        if "unmatched" in sample_result:
+            result["unmatched"] = merge_unmatched(result.get("unmatched", ({}, 0)), sample_result["unmatched"],
+                                                  input["unmatched_size"])
+    result["output"] = (np.concatenate(indices), np.concatenate(counts))
+    return result
 
 
 def revcomp(seq):
@@ -49,6 +1281,1066 @@ def revcomp(seq):
     return seq.translate(str.maketrans('ACGTacgtRYMKrymkVBHDvbhd', 'TGCAtgcaYRKMyrkmBVDHbvdh'))[::-1]
 
 
+def read_library(path):
+    """
+    Reads a library file, decompressing it if it is gzipped.
+    :param path: library file path, may be a pipe
+    :return: content of the library file
+    """
+    with open(path, "rb") as fh:
+        content = fh.read()
+    if content[:2] == b"\x1f\x8b":
+        content = gzip.decompress(content)
+    return content
+
+
+def compile_patterns(library, columns):
+    """
+    Numbers the distinct guide sequences of the given library columns and builds their automaton.
+    :param library: library table
+    :param columns: names of the guide sequence columns
+    :return: automaton reporting pattern ids, dictionary of guide sequences to pattern ids, the guide indices of
+    each pattern id as arrays (see pattern_guides), and the array of pattern ids of each column
+    """
+    lookup = {}
+    column_ids = []
+    for col_head in columns:
+        # add guide sequences to dictionary/tree
+        column_ids.append(np.fromiter((lookup.setdefault(substr, len(lookup)) for substr in library[col_head]),
+                                      dtype=np.int64, count=len(library)))
+    automaton = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+    for substr, pattern_id in lookup.items():
+        automaton.add_word(substr, pattern_id)
+    automaton.make_automaton()
+    guides = group_arrays(np.concatenate(column_ids), np.tile(np.arange(len(library)), len(columns)), len(lookup))
+    return automaton, lookup, guides, column_ids
+
+
+def compile_neighbours(lookup):
+    """
+    Builds the index of all sequences one mismatch away from the guide sequences, for rescuing reads with a sequencing
+    error in the guide. Sequences one mismatch away from more than one guide sequence are marked as ambiguous.
+    :param lookup: dictionary of guide sequences to pattern ids
+    :return: dictionary of guide lengths to a sorted array of 2-bit encoded sequences (uint64) and an array of their
+    pattern ids, -1 for ambiguous sequences
+    """
+    by_length = {}
+    for substr, pattern_id in lookup.items():
+        by_length.setdefault(len(substr), []).append((substr, pattern_id))
+    index = {}
+    for length, patterns in sorted(by_length.items()):
+        if length > 32:
+            raise ValueError("--max_mismatches supports guides of up to 32 bases")
+        keys, owners = encode_kmers([substr for substr, _ in patterns], length)
+        pattern_ids = np.array([pattern_id for _, pattern_id in patterns], dtype=np.int32)[owners]
+        # XOR of a 2-bit code with 1, 2 or 3 gives each of the three other bases
+        shifts = np.arange(length, dtype=np.uint64) * np.uint64(2)
+        flips = (np.arange(1, 4, dtype=np.uint64)[:, None] << shifts[None, :]).ravel()
+        variants = (keys[:, None] ^ flips[None, :]).ravel()
+        variant_ids = np.repeat(pattern_ids, len(flips))
+        order = np.argsort(variants, kind="stable")
+        variants = variants[order]
+        variant_ids = variant_ids[order]
+        starts = np.flatnonzero(np.r_[True, variants[1:] != variants[:-1]])
+        lowest = np.minimum.reduceat(variant_ids, starts)
+        highest = np.maximum.reduceat(variant_ids, starts)
+        index[length] = (variants[starts], np.where(lowest == highest, lowest, -1).astype(np.int32))
+        logging.info(f"count.py Mismatch index for {length} bp guides: {len(starts)} sequences,"
+                     f" {np.count_nonzero(lowest != highest)} ambiguous")
+    return index
+
+
+def compile_kmers(lookup):
+    """
+    Encodes the guide sequences for the numpy engine, which needs guides of up to 32 bases made of ACGT only.
+    :param lookup: dictionary of guide sequences to pattern ids
+    :return: dictionary of guide lengths to a sorted array of 2-bit encoded guide sequences (uint64) and an array of
+    their pattern ids
+    """
+    by_length = {}
+    for substr, pattern_id in lookup.items():
+        if not 0 < len(substr) <= 32 or substr.strip("ACGT"):
+            raise ValueError("--engine numpy supports guides of up to 32 bases of ACGT only, not " + substr)
+        by_length.setdefault(len(substr), []).append((substr, pattern_id))
+    index = {}
+    for length, patterns in sorted(by_length.items()):
+        keys, owners = encode_kmers([substr for substr, _ in patterns], length)
+        order = np.argsort(keys)
+        pattern_ids = np.array([pattern_id for _, pattern_id in patterns], dtype=np.int32)[owners]
+        index[length] = (keys[order], pattern_ids[order])
+    return index
+
+
+def orientation_columns(column, orientation):
+    """
+    :param column: name of a guide sequence column of the library, SEQ or SEQ2
+    :param orientation: forward, reverse or both
+    :return: names of the columns of the guide sequences matched in that orientation
+    """
+    return {"forward": [column], "reverse": [column + "rev"], "both": [column, column + "rev"]}[orientation]
+
+
+def compile_library(content, orientation, is_dual_guide, max_mismatches=0):
+    """
+    Compiles a library into the automatons and lookup tables used for counting.
+    :param content: content of the library file
+    :param orientation: orientations the guides are matched in, one of forward, reverse or both per guide column
+    :param is_dual_guide: the library contains dual guides
+    :param max_mismatches: 1 to also index the sequences one mismatch away from the guides
+    :return: dictionary with the "library" columns (CODE, GENES and the guide sequences, see pack_columns), the
+    automatons "auto" and "auto2", the dictionaries of guide sequences to pattern ids "lookup" and "lookup2", the guide
+    indices by pattern id "guides" and "guides2" and the dual guide "pairs" table (see pattern_guides and pair_table),
+    and the mismatch indexes "neighbours" and "neighbours2"
+    """
+    # pandas takes a while to import and is only needed for parsing the library, not when it is loaded from an index
+    import pandas as pd
+    with timed_phase("parse_library"):
+        library = pd.read_csv(io.BytesIO(content), sep="\t")
+    columns = ["CODE", "GENES", "SEQ", "SEQ2"] if is_dual_guide else ["CODE", "GENES", "SEQ"]
+    for column, column_orientation in zip(["SEQ", "SEQ2"], orientation):
+        if column_orientation != "forward":
+            library[column + "rev"] = library[column].apply(revcomp)
+    # create automaton for first guides
+    automaton, lookup, guides, ids = compile_patterns(library, orientation_columns("SEQ", orientation[0]))
+    automaton2 = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+    lookup2 = {}
+    guides2 = (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32))
+    pairs = guides2 * 2
+    # dual guide library?
+    if is_dual_guide:
+        automaton2, lookup2, guides2, ids2 = compile_patterns(library, orientation_columns("SEQ2", orientation[1]))
+        # a read pair matches the guides whose first and second guide sequences match in any orientation
+        keys = np.concatenate([column_ids * len(lookup2) + column_ids2 for column_ids in ids for column_ids2 in ids2])
+        pair_keys, key_rows = np.unique(keys, return_inverse=True)
+        indices = np.tile(np.arange(len(library)), len(ids) * len(ids2))
+        pairs = (np.searchsorted(pair_keys // len(lookup2), np.arange(len(lookup) + 1)).astype(np.int64),
+                 (pair_keys % len(lookup2)).astype(np.int32)) + \
+            group_arrays(key_rows.reshape(-1), indices, len(pair_keys))
+    neighbours = compile_neighbours(lookup) if max_mismatches else {}
+    neighbours2 = compile_neighbours(lookup2) if max_mismatches else {}
+    return {"library": pack_columns(library, columns), "auto": automaton, "auto2": automaton2, "lookup": lookup,
+            "lookup2": lookup2, "guides": guides, "guides2": guides2, "pairs": pairs, "neighbours": neighbours,
+            "neighbours2": neighbours2}
+
+
+def pack_columns(table, columns):
+    """
+    Packs text columns of a table into arrays of fixed width byte strings, which take a fraction of the memory of
+    Python strings.
+    :param table: table
+    :param columns: names of the columns
+    :return: dictionary of column names to arrays, empty cells become empty strings
+    """
+    return {column: np.array(table[column].fillna("").astype(str).str.encode("utf-8").tolist(), dtype=bytes)
+            for column in columns}
+
+
+def write_counts(path, library, counts, header=False):
+    """
+    Writes the count table: the CODE and GENES of each guide followed by its counts.
+    :param path: output file name
+    :param library: packed library columns, see pack_columns
+    :param counts: dictionary of column names to count arrays
+    :param header: write a header line with the column names
+    """
+    columns = [np.char.decode(library[column], "utf-8").tolist() for column in ["CODE", "GENES"]]
+    columns += [column.tolist() for column in counts.values()]
+    with open(path, "w", newline="") as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        if header:
+            writer.writerow(["CODE", "GENES"] + list(counts))
+        writer.writerows(zip(*columns))
+
+
+def load_library_index(path, orientation, is_dual_guide, index_dir=None, max_mismatches=0):
+    """
+    Loads the compiled index of a library from index_dir, or compiles it and saves it there. Index files are named
+    after a hash of the library content and the settings, so a changed library is compiled again automatically.
+    :param path: library file path
+    :param orientation: orientations the guides are matched in, see compile_library
+    :param is_dual_guide: the library contains dual guides
+    :param index_dir: directory of compiled library indexes, None to always compile the library
+    :param max_mismatches: 1 to also index the sequences one mismatch away from the guides
+    :return: compiled library index, see compile_library, with the SHA-256 "digest" of the library content and the
+    "orientation"
+    """
+    with timed_phase("read_library"):
+        content = read_library(path)
+    # identifies the library in partial counts, see write_partial
+    digest = hashlib.sha256(content).hexdigest()
+    if index_dir is None:
+        with timed_phase("compile_library"):
+            return dict(compile_library(content, orientation, is_dual_guide, max_mismatches), digest=digest,
+                        orientation=orientation)
+    key = hashlib.sha256(content)
+    key.update(f"format={index_format} orientation={'/'.join(orientation)} dual_guide={is_dual_guide}"
+               f" mismatches={max_mismatches}".encode())
+    index_file = os.path.join(index_dir, key.hexdigest() + ".idx")
+    if os.path.exists(index_file):
+        try:
+            with timed_phase("load_index"), open(index_file, "rb") as fh:
+                index = pickle.load(fh)
+            logging.info("count.py Loaded library index: " + index_file)
+            return dict(index, digest=digest, orientation=orientation)
+        except Exception as e:
+            # besides truncated files, an index pickled with other numpy or pandas versions may fail in many ways
+            logging.warning(f"count.py Ignoring unreadable library index {index_file}: {e}")
+    with timed_phase("compile_library"):
+        index = compile_library(content, orientation, is_dual_guide, max_mismatches)
+    os.makedirs(index_dir, exist_ok=True)
+    # write to a temporary file first, so that concurrent runs never see a partial index
+    with timed_phase("save_index"), tempfile.NamedTemporaryFile(dir=index_dir, suffix=".tmp", delete=False) as fh:
+        pickle.dump(index, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.chmod(fh.name, 0o644)
+    os.replace(fh.name, index_file)
+    logging.info("count.py Saved library index: " + index_file)
+    return dict(index, digest=digest, orientation=orientation)
+
+
+def build_index_main(argv):
+    """
+    The build-index command: compiles a library into --index_dir ahead of the counting runs.
+    :param argv: command line arguments after the command name
+    """
+    parser = argparse.ArgumentParser(description='Compile a CRISPR library into an index file that count.py runs'
+                                                 ' with the same --index_dir load instead of the library.',
+                                     prog='count.py build-index')
+    parser.add_argument('--lib', help='Filename of an input library.', required=True)
+    parser.add_argument('--dual_guide', help='Library contains dual guides.', action="store_true")
+    parser.add_argument('--no_rev_comp', help='Do not count reverse complements additionally.', action="store_true")
+    parser.add_argument('--orientation', help='Orientation the guides are matched in [default: both].',
+                        choices=["both", "forward", "reverse"], default="both")
+    parser.add_argument('--max_mismatches', help='Also index the sequences one mismatch away from the guides (1)'
+                                                 ' [default: 0].', default=0)
+    parser.add_argument('--index_dir', help='Directory of compiled library indexes.', required=True)
+    args = parser.parse_args(argv)
+    if args.max_mismatches not in (0, '0', '1'):
+        parser.error('--max_mismatches must be 0 or 1')
+    orientation = "forward" if args.no_rev_comp else args.orientation
+    load_library_index(args.lib, (orientation,) * (2 if args.dual_guide else 1), args.dual_guide, args.index_dir,
+                       int(args.max_mismatches))
+
+
+def sample_sequences(sample, args):
+    """
+    :param sample: list of reads, see open_reads
+    :param args: parsed command line arguments
+    :return: lists of the R1 and of the R2 sequences of the reads, the latter empty for single guides
+    """
+    if args.index_fastq:
+        sample = [read for read, _ in sample]
+    if not args.dual_guide:
+        return [line.strip() for line in sample], []
+    sample = [line if isinstance(line, tuple) else line.strip().split(args.dual_guide_seq_sep) for line in sample]
+    return [pair[0] for pair in sample], [pair[1] for pair in sample if len(pair) > 1]
+
+
+def find_orientation(samples, index, args):
+    """
+    Works out the orientation of the guides in the reads from the first --orientation_sample_size reads of each sample,
+    or of the first shard of the input (--orientation auto), so that the guides are only matched in that orientation.
+    :param samples: dictionary of sample names to their input files, see open_reads
+    :param index: compiled library index matching the guides in both orientations
+    :param args: parsed command line arguments
+    :return: orientation of the guides of each guide column, see compile_library
+    """
+    library = index["library"]
+    if args.shard:
+        # every shard samples the same reads, so that all of them count in the same orientation
+        args = argparse.Namespace(**dict(vars(args), shard=(1, args.shard[1])))
+    seqs, seqs2 = [], []
+    for source in samples.values():
+        sample_seqs, sample_seqs2 = sample_sequences(list(islice(open_sample(source, args),
+                                                                 int(args.orientation_sample_size))), args)
+        seqs += sample_seqs
+        seqs2 += sample_seqs2
+    orientation = (detect_orientation(seqs, index["auto"], library["SEQ"], index["guides"]),)
+    if args.dual_guide:
+        orientation += (detect_orientation(seqs2, index["auto2"], library["SEQ2"], index["guides2"], "R2"),)
+    return orientation
+
+
+def find_guide_slots(reads, index, args):
+    """
+    Works out the positions of the guides in the reads of a sample, which are looked up directly before searching the
+    whole read with the automatons (--guide_offset).
+    :param reads: iterable of reads of the sample
+    :param index: compiled library index
+    :param args: parsed command line arguments
+    :return: the reads (including any reads sampled for detecting the positions), and the (start, length) positions
+    of the first and second guides
+    """
+    library = index["library"]
+    slots = []
+    slots2 = []
+    if args.guide_offset == "auto":
+        sample = list(islice(reads, int(args.offset_sample_size)))
+        reads = chain(sample, reads)
+        seqs, seqs2 = sample_sequences(sample, args)
+        slots = detect_guide_slots(seqs, index["auto"], library["SEQ"], index["guides"])
+        if args.dual_guide:
+            slots2 = detect_guide_slots(seqs2, index["auto2"], library["SEQ2"], index["guides2"], "R2")
+    elif args.guide_offset is not None:
+        offset = int(args.guide_offset)
+        slots = [(offset, int(args.guide_length or np.bincount(np.char.str_len(library["SEQ"])).argmax()))]
+        if args.dual_guide:
+            slots2 = [(offset, int(args.guide_length or np.bincount(np.char.str_len(library["SEQ2"])).argmax()))]
+    return reads, slots, slots2
+
+
+def count_consumed(reads, consumed):
+    """
+    Counts the reads taken from an iterable, so that a checkpoint is only written once all of them have been counted.
+    :param reads: iterable of reads
+    :param consumed: one element list, incremented for each read
+    :return: generator of the reads
+    """
+    for read in reads:
+        consumed[0] += 1
+        yield read
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    Saves the counts so far atomically, so that a run killed at any time leaves either the previous or the new
+    checkpoint behind.
+    :param path: checkpoint file name
+    :param checkpoint: dictionary with the library "digest", the "settings" of the run, the "totals" of each sample
+    (whose reads count is the number of reads of the sample counted so far) and the names of the "finished" samples
+    """
+    # write to a temporary file first, like the library indexes
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp", delete=False) as fh:
+        pickle.dump(checkpoint, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fh.name, path)
+    reads = sum(sample_totals["reads"] for sample_totals in checkpoint["totals"].values())
+    logging.info(f"count.py Saved checkpoint after {reads} reads: " + path)
+
+
+def load_checkpoint(path, checkpoint):
+    """
+    Loads the checkpoint of an earlier run to resume from (--resume).
+    :param path: checkpoint file name
+    :param checkpoint: new checkpoint of this run, see save_checkpoint
+    :return: the checkpoint of the earlier run, or the new checkpoint if there is none
+    """
+    if not os.path.exists(path):
+        logging.info("count.py No checkpoint to resume from: " + path)
+        return checkpoint
+    with open(path, "rb") as fh:
+        resumed = pickle.load(fh)
+    if resumed["digest"] != checkpoint["digest"] or resumed["settings"] != checkpoint["settings"] or \
+            list(resumed["totals"]) != list(checkpoint["totals"]):
+        raise ValueError(f"Checkpoint {path} was written by a run with another library, settings or samples")
+    logging.info(f"count.py Resuming from checkpoint: {path}, " + ", ".join(
+        f"{name}: {sample_totals['reads']} reads" for name, sample_totals in resumed["totals"].items()))
+    return resumed
+
+
+def search_engine(index, engine):
+    """
+    :param index: compiled library index
+    :param engine: aho-corasick or numpy (--engine)
+    :return: the search function of the engine and the index the workers are initialised with, see init_worker
+    """
+    worker_index = {key: value for key, value in index.items() if key not in ("library", "digest")}
+    if engine != "numpy":
+        return exec_fragment_search, worker_index
+    worker_index["kmers"] = compile_kmers(index["lookup"])
+    worker_index["kmers2"] = compile_kmers(index["lookup2"])
+    row_starts, partners = index["pairs"][:2]
+    # the numpy engine looks up the packed pairs of pattern ids of all reads of a block at once
+    worker_index["pair_keys"] = (np.repeat(np.arange(len(row_starts) - 1), np.diff(row_starts))
+                                 * len(index["lookup2"]) + partners)
+    return exec_kmer_search, worker_index
+
+
+def count_samples(samples, index, args, barcodes=None):
+    """
+    Counts the guides in the reads of one or more samples. The samples are read one after the other, but their blocks
+    of reads share one pool of worker processes, so the workers stay busy across sample boundaries.
+    :param samples: dictionary of sample names to their input files, see open_reads
+    :param index: compiled library index
+    :param args: parsed command line arguments
+    :param barcodes: barcode sheet to demultiplex the reads of each sample with, see read_barcodes
+    :return: dictionary of sample names to their totals: the "output" count array, the number of "reads" and the
+    match counters; with barcodes the count matrix and arrays of the match counters and of the "sample_reads" of
+    each barcode sample, see demultiplex
+    """
+    processes = cpu_limit() if args.autotune else int(args.processes)
+    block_size = int(args.block_size)
+    num_guides = len(index["library"]["CODE"])
+    # the space-saving summaries of unmatched reads track more reads than are reported, which makes the counts of
+    # the reported ones more accurate
+    unmatched_size = 10 * int(args.unmatched_top) if args.unmatched else 0
+    totals = {name: {"output": np.zeros(num_guides, dtype=int), "reads": 0, **dict.fromkeys(counter_names, 0)}
+              for name in samples}
+    if barcodes:
+        # a row of counts and counters per sample of the barcode sheet, and one for the unassigned reads
+        rows = len(barcodes["samples"]) + 1
+        totals = {name: {"output": np.zeros((rows, num_guides), dtype=int), "reads": 0,
+                         "sample_reads": np.zeros(rows, dtype=int), **{key: np.zeros(rows, dtype=int)
+                                                                       for key in counter_names}}
+                  for name in samples}
+    checkpoint = None
+    if args.checkpoint:
+        settings = count_settings(args, index["orientation"]) + (f" shard={args.shard[0]}" if args.shard else "")
+        checkpoint = {"digest": index["digest"], "settings": settings, "totals": totals, "finished": []}
+        if args.resume:
+            checkpoint = load_checkpoint(args.checkpoint, checkpoint)
+            totals = checkpoint["totals"]
+    checkpoint_reads = int(args.checkpoint_reads)
+    checkpoint_seconds = float(args.checkpoint_seconds)
+    # --preview: every preview_every-th read is counted, and the estimates are reported every preview_interval reads
+    preview_every = int(args.preview_every) if args.preview else 1
+    preview_interval = int(args.preview_interval)
+    max_reads = int(args.max_reads) if args.max_reads else None
+    rng = np.random.default_rng(0)
+    run_stats["preview"] = []
+    # Find library sgRNAs in input nucleotide sequences
+    counter = 0
+    started = time.perf_counter()
+    last_checkpoint = (started, counter)
+    last_progress = (started, 0)
+    # time spent waiting for the next block of reads, and for the workers when the queue is full
+    input_wait = 0.0
+    worker_wait = 0.0
+    queue_depths = []
+    run_stats["throughput"] = []
+    # at most this many blocks are queued or being processed at any time, so the reader keeps running while the
+    # workers are busy without buffering the whole input in memory
+    max_pending_blocks = 2 * processes
+    # --autotune: number of blocks processed at a time and size of the blocks cut by raw_blocks, adjusted from the
+    # reads taken from the input, the time not spent waiting for the workers and the CPU time of the workers since
+    # the last adjustment
+    tuning = {"active": processes, "block_size": block_size}
+    # the workers beyond the active ones wait with their next block, see busy_worker
+    limit = (multiprocessing.Condition(), multiprocessing.RawValue("i", 0),
+             multiprocessing.RawValue("i", processes)) if args.autotune else None
+    window = {"started": started, "reads": 0, "worker_wait": 0.0, "counted": 0, "busy_s": 0.0}
+    block_sizes = iter(lambda: tuning["block_size"], None) if args.autotune else None
+    run_stats["autotune"] = []
+    # a single pool lives for the whole run; each worker receives the automatons once through the initializer
+    search, worker_index = search_engine(index, args.engine)
+    # the garbage collector of the workers would otherwise write to every object inherited from this process, so
+    # that each worker ends up with its own copy of the memory pages holding them
+    gc.freeze()
+    # future -> (name of the sample of its block, its slot of the ring, its number of reads)
+    pending = {}
+    # name -> count arrays of the samples with blocks being processed, see count_arrays
+    counts = {}
+    # blocks of reads not parsed by this process are passed to the workers in a ring of shared memory
+    ring = [None] * max_pending_blocks
+    free_slots = list(range(max_pending_blocks))
+    in_flight = Counter()
+    # name -> number of reads of the blocks whose results were collected
+    collected = Counter()
+    reading = None
+    # samples whose counts are scaled up to the reads they were subsampled from (--preview_every)
+    preview_samples = []
+    # reads submitted since the count arrays were last reduced: no count of a row can exceed it
+    unreduced = 0
+
+    def collect(future):
+        name, slot, block_reads = pending.pop(future)
+        process_result(totals[name], future, unmatched_size)
+        window["counted"] += block_reads
+        collected[name] += block_reads
+        window["busy_s"] += future.result()["worker"][3]
+        if slot is not None:
+            free_slots.append(slot)
+        in_flight[name] -= 1
+        if not in_flight[name] and name != reading:
+            reduce_counts(totals[name], counts.pop(name))
+
+    def drain():
+        nonlocal unreduced
+        for future in concurrent.futures.as_completed(pending):
+            collect(future)
+        for open_name in counts:
+            reduce_counts(totals[open_name], counts[open_name], release=False)
+        unreduced = 0
+
+    def preview_report(name, final=False):
+        with timed_phase("preview"):
+            if final:
+                drain()
+            else:
+                # the estimates are taken from the blocks done so far, without waiting for the others
+                for future in [future for future in pending if future.done()]:
+                    collect(future)
+            sample_totals = dict(totals[name], reads=collected[name])
+            if name in counts:
+                # the rows are only read: the workers may be adding to them
+                sample_totals["output"] = totals[name]["output"] + counts[name][1].sum(axis=0, dtype=np.int64)
+            estimates = preview_estimates(sample_totals, rng)
+        logging.info(f"count.py Preview {name}: {sample_totals['reads']} reads, " + ", ".join(
+            f"{key} {estimate:.4f} ({low:.4f}-{high:.4f})" for key, (estimate, low, high) in estimates.items()))
+        run_stats["preview"].append({"sample": name, "reads": sample_totals["reads"], **estimates})
+        return estimates
+
+    def retune(now):
+        if not window["busy_s"]:
+            return
+        reader = window["reads"] / max(now - window["started"] - window["worker_wait"], 1e-6)
+        worker = window["counted"] / window["busy_s"]
+        active, size = tune_settings(reader, worker, processes)
+        # the block size only changes by more than a quarter, so that it does not follow the noise of the measurements
+        if not 0.8 < size / tuning["block_size"] < 1.25 or active != tuning["active"]:
+            if not 0.8 < size / tuning["block_size"] < 1.25:
+                tuning["block_size"] = size
+            tuning["active"] = active
+            with limit[0]:
+                limit[2].value = active
+                limit[0].notify_all()
+            logging.info(f"count.py Autotune: {active} of {processes} workers busy, blocks of {tuning['block_size']}"
+                         f" reads (reader {reader:.0f} reads/s, {worker:.0f} reads/s per worker)")
+        run_stats["autotune"].append({"elapsed_s": round(now - started, 3), "reader_reads_s": round(reader),
+                                      "worker_reads_s": round(worker), **tuning})
+        window.update(started=now, reads=0, worker_wait=0.0, counted=0, busy_s=0.0)
+
+    try:
+        rows = multiprocessing.Value("i", 0)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                                    initargs=(worker_index, rows, limit)) as executor:
+            for name, source in samples.items():
+                if checkpoint and name in checkpoint["finished"]:
+                    continue
+                reading = name
+                counts[name] = count_arrays(processes, totals[name]["output"].size)
+                requested = time.perf_counter()
+                # reads counted before the checkpoint are skipped without matching them
+                consumed = [totals[name]["reads"]]
+                slots, slots2 = [], []
+                if args.collapse or args.guide_offset == "auto" or preview_every > 1 or \
+                        args.shard and source["input"] and is_bgzf(source["input"]):
+                    reads = count_consumed(islice(open_sample(source, args), consumed[0], None, preview_every),
+                                           consumed)
+                    reads, slots, slots2 = find_guide_slots(reads, index, args)
+                    if args.collapse:
+                        blocks = collapse_blocks(reads, block_size, int(args.collapse_limit))
+                    else:
+                        blocks = ((input_lines, None) for input_lines in read_blocks(reads, block_size))
+                    blocks = ((None, input_lines, weights, len(input_lines) if weights is None else sum(weights))
+                              for input_lines, weights in blocks)
+                else:
+                    # the workers read and parse the reads themselves
+                    _, slots, slots2 = find_guide_slots((), index, args)
+                    blocks = ((block, None, None, reads)
+                              for block, reads in raw_blocks(source, consumed[0], args, block_sizes))
+                # the estimates of the last --preview report of the sample with newly counted reads and their number,
+                # and the number of reads read at the last report
+                previous, previous_reads, reported = None, 0, 0
+                next_report = preview_interval
+                for block, input_lines, weights, block_reads in blocks:
+                    input_wait += time.perf_counter() - requested
+                    # with --autotune, one block waits behind each block processed by the busy workers
+                    while len(pending) >= (2 * tuning["active"] if args.autotune else max_pending_blocks):
+                        waited = time.perf_counter()
+                        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        worker_wait += time.perf_counter() - waited
+                        window["worker_wait"] += time.perf_counter() - waited
+                        for future in done:
+                            collect(future)
+                    if unreduced + block_reads > np.iinfo(np.int32).max:
+                        drain()
+                    unreduced += block_reads
+                    slot = None
+                    if block is not None:
+                        consumed[0] += block_reads
+                        if block[0] == "memory":
+                            slot = free_slots.pop()
+                            block = fill_ring_slot(ring, slot, block)
+                    future = executor.submit(timed_search, search, counts[name][0].name, block,
+                                             data_lines=input_lines, weights=weights, num_guides=num_guides,
+                                             is_dual_guide=args.dual_guide,
+                                             dual_guide_seq_sep=args.dual_guide_seq_sep, slots=slots, slots2=slots2,
+                                             unmatched_size=unmatched_size, barcodes=barcodes)
+                    pending[future] = (name, slot, block_reads)
+                    in_flight[name] += 1
+                    queue_depths.append(len(pending))
+                    totals[name]["reads"] += block_reads
+                    counter += block_reads
+                    window["reads"] += block_reads
+                    if args.autotune and time.perf_counter() - window["started"] >= autotune_seconds:
+                        retune(time.perf_counter())
+                    if counter // 1000000 > (counter - block_reads) // 1000000:
+                        now = time.perf_counter()
+                        current = (counter - last_progress[1]) / (now - last_progress[0])
+                        logging.info(f'count.py Processed reads: {counter} ({current:.0f} reads/s,'
+                                     f' {counter / (now - started):.0f} reads/s on average)')
+                        run_stats["throughput"].append({"elapsed_s": round(now - started, 3), "reads": counter})
+                        last_progress = (now, counter)
+                    # a checkpoint can only be taken when all reads taken from the input are in submitted blocks,
+                    # which is not the case while collapsing a window of reads
+                    if checkpoint and consumed[0] == totals[name]["reads"] and \
+                            (counter - last_checkpoint[1] >= checkpoint_reads or
+                             time.perf_counter() - last_checkpoint[0] >= checkpoint_seconds):
+                        with timed_phase("checkpoint"):
+                            drain()
+                            save_checkpoint(args.checkpoint, checkpoint)
+                        last_checkpoint = (time.perf_counter(), counter)
+                    sample_reads = totals[name]["reads"]
+                    if args.preview and (sample_reads >= next_report or max_reads and sample_reads >= max_reads):
+                        estimates = preview_report(name)
+                        reported = sample_reads
+                        next_report = (sample_reads // preview_interval + 1) * preview_interval
+                        # a report without newly counted blocks repeats the estimates of the report before
+                        if collected[name] > previous_reads and \
+                                preview_converged(estimates, previous, float(args.preview_tolerance)):
+                            logging.info(f"count.py Preview {name}: converged after {sample_reads} reads")
+                            break
+                        if max_reads and sample_reads >= max_reads:
+                            logging.info(f"count.py Preview {name}: stopped at --max_reads after {sample_reads} reads")
+                            break
+                        if collected[name] > previous_reads:
+                            previous, previous_reads = estimates, collected[name]
+                    requested = time.perf_counter()
+                else:
+                    # the last estimates of a sample that ends before they converge
+                    if args.preview and reported < totals[name]["reads"]:
+                        preview_report(name, final=True)
+                input_wait += time.perf_counter() - requested
+                reading = None
+                if not in_flight[name]:
+                    reduce_counts(totals[name], counts.pop(name))
+                if preview_every > 1:
+                    preview_samples.append(name)
+                if checkpoint:
+                    checkpoint["finished"].append(name)
+            # merge whatever is still in flight
+            waited = time.perf_counter()
+            for future in concurrent.futures.as_completed(pending):
+                worker_wait += time.perf_counter() - waited
+                collect(future)
+                waited = time.perf_counter()
+    finally:
+        gc.unfreeze()
+        for memory in ring:
+            if memory is not None:
+                memory.close()
+                memory.unlink()
+        for memory, _ in counts.values():
+            memory.unlink()
+    for name in preview_samples:
+        # the counts of the subsample stand for preview_every times as many reads
+        for key in ["output", "reads"] + counter_names:
+            totals[name][key] = totals[name][key] * preview_every
+    elapsed = time.perf_counter() - started
+    run_stats["throughput"].append({"elapsed_s": round(elapsed, 3), "reads": counter})
+    if args.autotune:
+        logging.info(f"count.py Autotune: {tuning['active']} of {processes} workers busy, blocks of"
+                     f" {tuning['block_size']} reads, {counter / elapsed:.0f} reads/s")
+    run_stats.update({"count_wall_s": elapsed, "input_wait_s": input_wait, "worker_wait_s": worker_wait,
+                      "queue_depth": {"max": max(queue_depths, default=0),
+                                      "mean": sum(queue_depths) / len(queue_depths) if queue_depths else 0}})
+    return totals
+
+
+def library_content(records, is_dual_guide):
+    """
+    :param records: library records with the CODE, GENES, SEQ and for dual guides SEQ2 columns, as dictionaries or
+    sequences in that order
+    :param is_dual_guide: the library contains dual guides
+    :return: the records as the content of a library file
+    """
+    columns = ["CODE", "GENES", "SEQ", "SEQ2"] if is_dual_guide else ["CODE", "GENES", "SEQ"]
+    rows = ([record[column] for column in columns] if isinstance(record, dict) else record for record in records)
+    return "\n".join("\t".join(map(str, row)) for row in chain([columns], rows)).encode() + b"\n"
+
+
+class GuideCounter:
+    """
+    Counts the guides of a library in batches of reads in this process, for counting from Python without running
+    count.py:
+
+        counter = GuideCounter("library.tsv")
+        for reads in batches:
+            counter.update(reads)
+        counts = counter.result()["output"]
+
+    Counters of several libraries can be used side by side: the search functions read the library from module-level
+    globals, which are set to the library of a counter whenever it counts.
+    """
+
+    def __init__(self, library, dual_guide=False, count_revcomp=True, max_mismatches=0, index_dir=None,
+                 engine="aho-corasick", dual_guide_seq_sep="\t"):
+        """
+        :param library: library file name, or records of the library, see library_content
+        :param dual_guide: the library contains dual guides
+        :param count_revcomp: also match reverse complements of the guides
+        :param max_mismatches: maximum number of mismatches between a guide and a read, 0 or 1
+        :param index_dir: directory of compiled library indexes for library files, see load_library_index
+        :param engine: aho-corasick or numpy, see exec_fragment_search and exec_kmer_search
+        :param dual_guide_seq_sep: separator of the R1 and R2 sequences of reads given as lines
+        """
+        orientation = ("both" if count_revcomp else "forward",) * (2 if dual_guide else 1)
+        if isinstance(library, (str, os.PathLike)):
+            self.index = load_library_index(os.fspath(library), orientation, dual_guide, index_dir, max_mismatches)
+        else:
+            content = library_content(library, dual_guide)
+            self.index = dict(compile_library(content, orientation, dual_guide, max_mismatches),
+                              digest=hashlib.sha256(content).hexdigest(), orientation=orientation)
+        self.search, self.worker_index = search_engine(self.index, engine)
+        self.dual_guide = dual_guide
+        self.max_mismatches = int(max_mismatches)
+        self.dual_guide_seq_sep = dual_guide_seq_sep
+        self.totals = {"output": np.zeros(len(self.index["library"]["CODE"]), dtype=int), "reads": 0,
+                       **dict.fromkeys(counter_names, 0)}
+
+    def update(self, reads):
+        """
+        Counts a batch of reads.
+        :param reads: iterable of reads: sequences, or for dual guides (R1, R2) tuples or lines with both sequences
+        :return: this counter
+        """
+        global installed_index
+        if installed_index is not self.worker_index:
+            init_worker(self.worker_index)
+            installed_index = self.worker_index
+        # searched in blocks like count_samples does, so that memory use does not grow with the number of reads
+        for block in read_blocks(reads, default_block_size):
+            result = self.search(data_lines=block, num_guides=len(self.totals["output"]),
+                                 is_dual_guide=self.dual_guide, dual_guide_seq_sep=self.dual_guide_seq_sep)
+            add_counts(self.totals["output"], result["output"])
+            for name in counter_names:
+                self.totals[name] += result[name]
+            self.totals["reads"] += len(block)
+        return self
+
+    def update_pairs(self, r1, r2):
+        """
+        Counts a batch of read pairs of a dual guide library.
+        :param r1: iterable of R1 sequences
+        :param r2: iterable of the R2 sequences of the same pairs
+        :return: this counter
+        """
+        return self.update(zip(r1, r2, strict=True))
+
+    def merge(self, other):
+        """
+        Adds the counts of another counter of the same library and settings, eg one that counted other reads in
+        another process.
+        :param other: GuideCounter
+        :return: this counter
+        """
+        if other.index["digest"] != self.index["digest"] or other.dual_guide != self.dual_guide:
+            raise ValueError("Cannot merge the counts of different libraries")
+        if other.index["orientation"] != self.index["orientation"] or other.max_mismatches != self.max_mismatches:
+            raise ValueError("Cannot merge counts matched with different count_revcomp or max_mismatches settings")
+        for name, value in other.totals.items():
+            self.totals[name] += value
+        return self
+
+    def result(self):
+        """
+        :return: the totals so far: a copy of the "output" count array, in the order of the library, the number of
+        "reads" and the match counters
+        """
+        return dict(self.totals, output=self.totals["output"].copy())
+
+
+def peak_rss_mb(who):
+    """
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    :return: peak resident set size of this process, or of the largest of its finished child processes, in MB
+    """
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return resource.getrusage(who).ru_maxrss / (1 << 20 if platform.system() == "Darwin" else 1 << 10)
+
+
+def write_stats(totals, path, wall, cpu):
+    """
+    Writes the timings, throughput, worker usage, --autotune adjustments, peak memory use and match counters of the
+    run as JSON.
+    :param totals: dictionary of sample names to their totals, see count_samples
+    :param path: output file name
+    :param wall: wall clock time of the run in seconds
+    :param cpu: CPU time of the main process in seconds
+    """
+    reads = sum(sample_totals["reads"] for sample_totals in totals.values())
+    count_wall = run_stats.get("count_wall_s", 0.0)
+    workers = [{"pid": pid, **worker, "idle_s": max(count_wall - worker["busy_s"], 0.0)}
+               for pid, worker in sorted(run_stats.get("workers", {}).items())]
+    stats = {"version": version, "command": sys.argv, "wall_s": wall, "cpu_s": cpu,
+             "phases": run_stats.get("phases", {}), "reads": reads,
+             "reads_per_s": reads / count_wall if count_wall else 0.0,
+             "throughput": run_stats.get("throughput", []), "input_wait_s": run_stats.get("input_wait_s", 0.0),
+             "worker_wait_s": run_stats.get("worker_wait_s", 0.0), "merge_s": run_stats.get("merge_s", 0.0),
+             "queue_depth": run_stats.get("queue_depth", {}), "workers": workers,
+             "autotune": run_stats.get("autotune", []), "preview": run_stats.get("preview", []),
+             "peak_rss_mb": {"main": peak_rss_mb(resource.RUSAGE_SELF),
+                             "workers": peak_rss_mb(resource.RUSAGE_CHILDREN)},
+             "samples": {name: {key: sample_totals[key] for key in ["reads"] + counter_names}
+                         for name, sample_totals in totals.items()}}
+    with open(path, "w") as fh:
+        json.dump(stats, fh, indent=2)
+
+
+def split_samples(sample_totals, names):
+    """
+    Splits the totals of demultiplexed reads into the totals of their samples, see count_samples.
+    :param sample_totals: totals with a row per sample
+    :param names: names of the rows
+    :return: dictionary of sample names to their totals
+    """
+    return {name: {"output": sample_totals["output"][row], "reads": int(sample_totals["sample_reads"][row]),
+                   **{key: int(sample_totals[key][row]) for key in counter_names}}
+            for row, name in enumerate(names)}
+
+
+def wilson_interval(successes, trials, z=1.96):
+    """
+    :param successes: number of successes
+    :param trials: number of trials
+    :param z: quantile of the standard normal distribution of the confidence level, 1.96 for 95%
+    :return: Wilson score interval of the proportion of successes
+    """
+    if not trials:
+        return 0.0, 1.0
+    p = successes / trials
+    centre = (p + z * z / (2 * trials)) / (1 + z * z / trials)
+    half = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / (1 + z * z / trials)
+    return max(centre - half, 0.0), min(centre + half, 1.0)
+
+
+def gini_index(counts):
+    """
+    :param counts: count array
+    :return: Gini index of the counts, 0 when all counts are the same and close to 1 when a few guides have them all
+    """
+    total = counts.sum()
+    if not total:
+        return 0.0
+    ranks = np.arange(1, len(counts) + 1)
+    return float(2 * (ranks * np.sort(counts)).sum() / (len(counts) * total) - (len(counts) + 1) / len(counts))
+
+
+def preview_estimates(sample_totals, rng):
+    """
+    Estimates the measures of how well the library is represented in a sample from the reads counted so far
+    (--preview): the fractions of the reads with a match, with several matches and with mismatching guides, with
+    Wilson score intervals, and the Gini index of the counts and the fraction of the guides without a count, with
+    intervals of 1.96 standard deviations of preview_resamples multinomial resamples of the counts.
+    :param sample_totals: totals of the sample, see count_samples
+    :param rng: random number generator for the resamples
+    :return: dictionary of measure names to (estimate, lower bound, upper bound) of their 95% interval
+    """
+    reads = sample_totals["reads"]
+    matches = sample_totals["unique_matches"] + sample_totals["multi_matches"] + sample_totals["rescued_matches"]
+    estimates = {name: (count / reads if reads else 0.0,) + wilson_interval(count, reads)
+                 for name, count in [("hit_rate", matches), ("multi_matches", sample_totals["multi_matches"]),
+                                     ("mismatching_pairs", sample_totals["mismatching_pairs"])]}
+    counts = sample_totals["output"]
+    total = int(counts.sum())
+    resamples = [rng.multinomial(total, counts / total) if total else counts for _ in range(preview_resamples)]
+    for name, measure in [("gini", gini_index), ("zero_guides", lambda values: float(np.mean(values == 0)))]:
+        estimate = measure(counts)
+        # resampling sparse counts loses guides with few reads, which shifts the values of the resamples, so only
+        # their spread is used
+        error = 1.96 * float(np.std([measure(resample) for resample in resamples]))
+        estimates[name] = (estimate, max(estimate - error, 0.0), min(estimate + error, 1.0))
+    return estimates
+
+
+def preview_converged(estimates, previous, tolerance):
+    """
+    :param estimates: the latest estimates, see preview_estimates
+    :param previous: the estimates of the report before, or None
+    :param tolerance: --preview_tolerance
+    :return: True once each interval is at most 2 * tolerance wide and each estimate changed by at most tolerance
+    since the report before
+    """
+    return previous is not None and all(
+        high - low <= 2 * tolerance and abs(estimate - previous[name][0]) <= tolerance
+        for name, (estimate, low, high) in estimates.items())
+
+
+def write_summary(totals, path):
+    """
+    Writes the number of reads and the match counters of each sample as a tab delimited table.
+    :param totals: dictionary of sample names to their totals, see count_samples
+    :param path: output file name
+    """
+    with open(path, "w", newline="") as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "reads"] + counter_names)
+        for name, sample_totals in totals.items():
+            writer.writerow([name, sample_totals["reads"]] + [sample_totals[key] for key in counter_names])
+
+
+def summarise_unmatched(unmatched, capacity):
+    """
+    Counts the unmatched reads of a block, keeping the most frequent ones (see merge_unmatched).
+    :param unmatched: list of (read or read pair key, weight)
+    :param capacity: maximum number of reads kept
+    :return: space-saving summary: dictionary of reads to their (count, maximum undercount), and the maximum count of
+    the reads left out
+    """
+    counts = Counter()
+    for key, weight in unmatched:
+        counts[key] += weight
+    top = counts.most_common(capacity + 1)
+    floor = top.pop()[1] if len(top) > capacity else 0
+    return {key: (count, 0) for key, count in top}, floor
+
+
+def merge_unmatched(summary, other, capacity):
+    """
+    Merges two space-saving summaries of unmatched reads, so that memory stays bounded however many distinct reads
+    there are. A read missing from a summary may have occurred up to that summary's maximum count of the reads left
+    out, which is added to its maximum undercount; the reads with the highest possible counts are kept.
+    :param summary: space-saving summary, see summarise_unmatched
+    :param other: space-saving summary
+    :param capacity: maximum number of reads kept
+    :return: merged space-saving summary
+    """
+    (items, floor), (items2, floor2) = summary, other
+    merged = {}
+    for key in items.keys() | items2.keys():
+        count, error = items.get(key, (0, floor))
+        count2, error2 = items2.get(key, (0, floor2))
+        merged[key] = (count + count2, error + error2)
+    floor += floor2
+    if len(merged) > capacity:
+        ranked = sorted(merged.items(), key=lambda item: (-sum(item[1]), str(item[0])))
+        floor = max(floor, sum(ranked[capacity][1]))
+        merged = dict(ranked[:capacity])
+    return merged, floor
+
+
+def write_unmatched(totals, path, index, top):
+    """
+    Writes the most frequent unmatched reads of each sample as a tab delimited table. For dual guides each read of a
+    pair is given by the guide sequences found in it, or by the read itself if none were found.
+    :param totals: dictionary of sample names to their totals, see count_samples
+    :param path: output file name
+    :param index: compiled library index
+    :param top: number of reads written per sample
+    """
+    patterns = (list(index["lookup"]), list(index["lookup2"]))
+    with open(path, "w", newline="") as fh:
+        writer = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        reads = ["read1", "read2"] if "SEQ2" in index["library"] else ["read"]
+        writer.writerow(["sample"] + reads + ["count", "max_count"])
+        for name, sample_totals in totals.items():
+            items = sample_totals.get("unmatched", ({}, 0))[0].items()
+            for key, (count, error) in sorted(items, key=lambda item: (-item[1][0], -item[1][1], str(item[0])))[:top]:
+                if isinstance(key, str):
+                    key = [key]
+                else:
+                    key = [part if isinstance(part, str) else ",".join(patterns[read][i] for i in part)
+                           for read, part in enumerate(key)]
+                writer.writerow([name] + key + [count, count + error])
+
+
+def count_settings(args, orientation):
+    """
+    Describes the settings the counts depend on, which must be the same for counts to be added up: those of partial
+    counts of the shards of a sample, or of a checkpoint and the run resuming from it.
+    :param args: parsed command line arguments
+    :param orientation: orientation the guides are matched in, see compile_library; with --orientation auto that of
+    the reads of the run
+    :return: settings string
+    """
+    settings = f"dual_guide={args.dual_guide} orientation={'/'.join(orientation)} mismatches={args.max_mismatches}"
+    if args.barcodes:
+        settings += f" barcodes={args.barcodes}"
+    if args.shard:
+        # all shards must split the input the same way
+        settings += f" shards={args.shard[1]}"
+        if not args.input:
+            settings += f" block_size={args.block_size}"
+    return settings
+
+
+def write_partial(sample_totals, path, name, index, args):
+    """
+    Writes the counts and match counters of one --shard of a sample as a compressed NumPy .npz file, which the merge
+    command adds up with those of the other shards.
+    :param sample_totals: totals of the sample, see count_samples
+    :param path: output file name, used as is
+    :param name: sample name
+    :param index: compiled library index
+    :param args: parsed command line arguments
+    """
+    shard, shards = args.shard
+    # the merge command checks that all shards were cut from the same input files
+    inputs = " ".join(f"{file}={os.path.getsize(file) if os.path.isfile(file) else ''}"
+                      for file in (args.input, args.fastq, args.r1, args.r2, args.index_fastq) if file)
+    with open(path, "wb") as fh:
+        np.savez_compressed(fh, output=sample_totals["output"].astype(np.int64), shard=np.array([shard, shards]),
+                            totals=np.array([sample_totals[key] for key in ["reads"] + counter_names], dtype=np.int64),
+                            sample=np.array(name), library=np.array(index["digest"]),
+                            settings=np.array(count_settings(args, index["orientation"])), inputs=np.array(inputs))
+
+
+def merge_partials(paths, digest):
+    """
+    Adds up the partial counts of the shards of a sample, see write_partial. Every shard must be there exactly once.
+    :param paths: partial count file names
+    :param digest: SHA-256 of the content of the library the partial counts must have been counted with
+    :return: name of the sample and its totals, see count_samples
+    """
+    totals = None
+    shards_seen = set()
+    for path in paths:
+        with np.load(path) as partial:
+            if str(partial["library"]) != digest:
+                raise ValueError(f"{path} was counted with a different library")
+            shard, shards = partial["shard"].tolist()
+            if totals is None:
+                name = str(partial["sample"])
+                settings = str(partial["settings"])
+                inputs = str(partial["inputs"])
+                totals = {"output": np.zeros(len(partial["output"]), dtype=int), "reads": 0,
+                          **dict.fromkeys(counter_names, 0)}
+            elif str(partial["sample"]) != name:
+                raise ValueError(f"{path} is a shard of sample {partial['sample']}, {paths[0]} of sample {name}")
+            elif str(partial["inputs"]) != inputs:
+                raise ValueError(f"{path} was counted from other input files ({partial['inputs']}) than {paths[0]}"
+                                 f" ({inputs})")
+            elif str(partial["settings"]) != settings:
+                raise ValueError(f"{path} was counted with other settings ({partial['settings']}) than {paths[0]}"
+                                 f" ({settings})")
+            if shard in shards_seen:
+                raise ValueError(f"Shard {shard}/{shards} is given twice")
+            shards_seen.add(shard)
+            totals["output"] += partial["output"]
+            for key, value in zip(["reads"] + counter_names, partial["totals"].tolist()):
+                totals[key] += value
+    missing = sorted(set(range(1, shards + 1)) - shards_seen)
+    if missing:
+        raise ValueError(f"Missing shards {', '.join(map(str, missing))} of {shards}")
+    return name, totals
+
+
+def merge_main(argv):
+    """
+    The merge command: adds up the partial counts of the --shard runs of a sample into the final count table.
+    :param argv: command line arguments after the command name
+    """
+    parser = argparse.ArgumentParser(description='Add up the partial counts written by count.py --shard runs into the'
+                                                 ' count table of the whole input.', prog='count.py merge')
+    parser.add_argument('--lib', help='Filename of the library the shards were counted with.', required=True)
+    parser.add_argument('--out', help='Output text file name.', required=True)
+    parser.add_argument('--summary', help='Output text file name for the number of reads and the match counters.')
+    parser.add_argument('partials', help='Partial count files of all shards.', nargs='+')
+    args = parser.parse_args(argv)
+    content = read_library(args.lib)
+    try:
+        name, sample_totals = merge_partials(args.partials, hashlib.sha256(content).hexdigest())
+    except ValueError as e:
+        parser.error(str(e))
+    import pandas as pd
+    library = pack_columns(pd.read_csv(io.BytesIO(content), sep="\t"), ["CODE", "GENES"])
+    write_counts(args.out, library, {"count": sample_totals["output"]})
+    logging.info("reads\tunique matches\tmulti matches\tmismatching pairs\n" + str(sample_totals["reads"])
+                 + "\t" + str(sample_totals["unique_matches"]) + "\t" + str(sample_totals["multi_matches"])
+                 + "\t" + str(sample_totals["mismatching_pairs"]))
+    if args.summary:
+        write_summary({name: sample_totals}, args.summary)
+
+
 def main(args):
     """
     For a given CRISPR library use Aho-Corasick to count instances in input
@@ -61,182 +2353,459 @@ def main(args):
     # already the default on Linux.
     if platform.system() == 'Darwin':
        multiprocessing.set_start_method('fork')
+    started = time.perf_counter()
+    run_stats.clear()
 
-    # library tsv file (to be added as an option)
-    library = pd.read_csv(args.lib, sep="\t")
-    count_revcomp = not args.no_rev_comp
+    orientation = "forward" if args.no_rev_comp else args.orientation
     output_file = args.out
-    input_file = args.input
+    input_file = args.samples or args.input or args.fastq or args.r1 + " " + args.r2
     is_dual_guide = args.dual_guide
-    processes = int(args.processes)
-    block_size = int(args.block_size)
-    if count_revcomp:  # help with creating a dictionary by
-        library["SEQrev"] = library["SEQ"].apply(revcomp)
-        if is_dual_guide:
-            library["SEQ2rev"] = library["SEQ2"].apply(revcomp)
-    dual_guide_seq_sep = args.dual_guide_seq_sep
+    processes = cpu_limit() if args.autotune else int(args.processes)
     logging.info("count.py Input library file: " + input_file)
     logging.info("count.py Dual guide library: " + str(is_dual_guide))
-    logging.info("count.py Count reverse complements: " + str(count_revcomp))
+    logging.info("count.py Count reverse complements: " + str(orientation != "forward"))
     logging.info("count.py Processes: " + str(processes))
-    # resulting dataframe
-    outputdf = library[["CODE", "GENES"]]
-    # temporary holder for counts (numpy, fast)
-    global temp_output
-    temp_output = np.zeros(outputdf.shape[0], dtype=int)
-    # create automaton for first guides
-    loop_through = ["SEQ"]
-    if count_revcomp:
-        loop_through += ["SEQrev"]
-    temp_dict = {}
-    for col_head in loop_through:
-        for substr, index, guide in zip(library[col_head], outputdf.index, library["CODE"]):
-            # add guide sequence to dictionary/tree
-            if substr not in temp_dict:
-                temp_dict[substr] = {index}
-            else:
-                temp_dict[substr].add(index)
-    # put unique keys into dict
-    for my_key in temp_dict:
-        auto.add_word(my_key, temp_dict[my_key])
-    auto.make_automaton()
-
-    # dual guide library?
-    if is_dual_guide:
-        temp_dict2 = {}
-        loop_through = ["SEQ2"]
-        if count_revcomp:
-            loop_through += ["SEQ2rev"]
-        for col_head in loop_through:
-            for substr, index, guide in zip(library[col_head], outputdf.index, library["CODE"]):
-                if substr not in temp_dict2:
-                    temp_dict2[substr] = {index}
-                else:
-                    temp_dict2[substr].add(index)
-        for my_key in temp_dict2:
-            auto2.add_word(my_key, temp_dict2[my_key])
-        auto2.make_automaton()
-    # Find library sgRNAs in input nucleotide sequences
-    counter = 0
-
-    # a temporary holder for sequence reads with each bucket holding a certain number of reads (block_size)
-    input_lines_collection = [[] for _ in range(processes)]
-    for line in fileinput.input(input_file):  # loop through input sequencing reads
-        futures = []
-        counter += 1
-        # assign reads to buckets
-        input_lines_collection[(counter - 1) % processes].append(line)
-        if counter % (processes * block_size) > 0:
-            continue
-        if counter % 1000000 == 0:
-            logging.info('count.py Processed reads: ' + str(counter))
-        # submit buckets to parallel processing
-        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
-            for input_lines in input_lines_collection:
-                futures.append(executor.submit(exec_fragment_search, data_lines=input_lines,
-                                               num_guides=outputdf.shape[0], is_dual_guide=is_dual_guide,
-                                               dual_guide_seq_sep=dual_guide_seq_sep))
-        for future in futures:
-            future.add_done_callback(process_result)
-
-        # wait for processing to finish until reading in more sequence reads
-        concurrent.futures.wait(futures)
-
-        input_lines_collection = [[] for _ in range(processes)]
-
-    # flush remaining table
-    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
-        futures = []
-        for input_lines in input_lines_collection:
-            if len(input_lines) > 0:
-                futures.append(executor.submit(exec_fragment_search, data_lines=input_lines,
-                                               num_guides=outputdf.shape[0], is_dual_guide=is_dual_guide,
-                                               dual_guide_seq_sep=dual_guide_seq_sep))
-        for future in futures:
-            future.add_done_callback(process_result)
-    executor.shutdown(wait=True)
-    # create output struct from numpy array and guide and gene names
-    outputdf.insert(2, "count", pd.Series(temp_output))
-    outputdf.to_csv(output_file, sep="\t", header=False, index=False)
-    logging.info("reads\tunique matches\tmulti matches\tmismatching pairs\n" + str(counter)
-                 + "\t" + str(unique_matches) + "\t" + str(multi_matches) + "\t" + str(mismatching_pairs))
+    if args.samples:
+        samples = read_sample_sheet(args.samples, args)
+    else:
+        samples = {input_file: {"input": args.input, "fastq": args.fastq, "r1": args.r1, "r2": args.r2,
+                                "index": args.index_fastq}}
+    barcodes = read_barcodes(args.barcodes, args) if args.barcodes else None
+    guide_columns = 2 if is_dual_guide else 1
+    if orientation == "auto":
+        index = load_library_index(args.lib, ("both",) * guide_columns, is_dual_guide, args.index_dir,
+                                   int(args.max_mismatches))
+        with timed_phase("detect_orientation"):
+            orientation = find_orientation(samples, index, args)
+        # the guides are only matched in the orientation of the reads for the rest of the run
+        if orientation != index["orientation"]:
+            index = load_library_index(args.lib, orientation, is_dual_guide, args.index_dir, int(args.max_mismatches))
+    else:
+        index = load_library_index(args.lib, (orientation,) * guide_columns, is_dual_guide, args.index_dir,
+                                   int(args.max_mismatches))
+    with timed_phase("count"):
+        totals = count_samples(samples, index, args, barcodes)
+    # the unmatched reads are reported for the whole input when demultiplexing
+    unmatched = totals
+    if barcodes:
+        totals = split_samples(totals[input_file], barcodes["samples"] + ["unassigned"])
+    if args.shard:
+        # partial counts of one shard of the input, added up by the merge command
+        with timed_phase("write_output"):
+            write_partial(totals[input_file], output_file, input_file, index, args)
+        sample_totals = totals[input_file]
+        logging.info(f"count.py Shard {args.shard[0]}/{args.shard[1]}: " + "\t".join(
+            str(sample_totals[key]) for key in ["reads"] + counter_names))
+    elif args.samples or barcodes:
+        # one column of counts per sample
+        with timed_phase("write_output"):
+            write_counts(output_file, index["library"],
+                         {name: sample_totals["output"] for name, sample_totals in totals.items()}, header=True)
+        for name, sample_totals in totals.items():
+            logging.info(f"count.py Sample {name}: " + "\t".join(
+                str(sample_totals[key]) for key in ["reads"] + counter_names))
+    else:
+        sample_totals = totals[input_file]
+        with timed_phase("write_output"):
+            write_counts(output_file, index["library"], {"count": sample_totals["output"]})
+        logging.info("reads\tunique matches\tmulti matches\tmismatching pairs\n" + str(sample_totals["reads"])
+                     + "\t" + str(sample_totals["unique_matches"]) + "\t" + str(sample_totals["multi_matches"])
+                     + "\t" + str(sample_totals["mismatching_pairs"]))
+        if int(args.max_mismatches):
+            logging.info("count.py Reads rescued with one mismatch: " + str(sample_totals["rescued_matches"]))
+    if args.summary:
+        write_summary(totals, args.summary)
+    if args.unmatched:
+        write_unmatched(unmatched, args.unmatched, index, int(args.unmatched_top))
+    if args.stats_json:
+        write_stats(totals, args.stats_json, time.perf_counter() - started, time.process_time())
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        # the run is complete, a rerun must not resume from it
+        os.remove(args.checkpoint)
 
 
 def exec_fragment_search(**input):
     lines = input["data_lines"]
+    # number of reads each line stands for when identical reads were collapsed
+    weights = input.get("weights")
+    if weights is None:
+        weights = repeat(1)
     is_dual_guide = input["is_dual_guide"]
     dual_guide_seq_sep = input["dual_guide_seq_sep"]
-    num_guides = input["num_guides"]
+    # (start, length) read positions at which the first and second guides are looked up before searching the read
+    guide_slots = input.get("slots", [])
+    guide_slots2 = input.get("slots2", [])
     multi_matches = 0
     unique_matches = 0
     mismatching_pairs = 0
-    output = np.zeros(num_guides, dtype=int)
-    for line in lines:
+    # guide index -> count: a block of reads hits few of the guides of a large library, see sparse_counts
+    output = {}
+    # reads without an exact match, retried with one mismatch after the block if there is a mismatch index
+    rescue = []
+    # (read or read pair, weight) of the reads without a match, for the report of unmatched reads (--unmatched)
+    unmatched = [] if input.get("unmatched_size") else None
+    starts, guides = pattern_guides
+    for line, weight in zip(lines, weights):
         if is_dual_guide:
-            # input data is expected to be two nucleotide sequences separated by a symbol (default: tab)
-            linesplit = line.strip().split(dual_guide_seq_sep)
-
-            # potentially faster way relying a bit on C backend
-            matches1 = list(map(itemgetter(1),
-                                [*auto.iter(linesplit[0])]))  # use itemgetter to ignore first arg from iterator
-            len1 = len(matches1)
-            if len1 == 0:
+            if isinstance(line, tuple):  # R1 and R2 sequences read from paired FASTQ files
+                linesplit = line
+            else:
+                # input data is expected to be two nucleotide sequences separated by a symbol (default: tab)
+                linesplit = line.strip().split(dual_guide_seq_sep)
+
+            ids1 = lookup_guides(linesplit[0], guide_slots, guide_lookup)
+            if not ids1:
+                ids1 = [x for _, x in auto.iter(linesplit[0])]
+            if not ids1 and not neighbours and unmatched is None:
                 continue
-            matches2 = list(map(itemgetter(1), [*auto2.iter(linesplit[1])]))
-            len2 = len(matches2)
-            if len2 == 0:
+            ids2 = lookup_guides(linesplit[1], guide_slots2, guide_lookup2)
+            if not ids2:
+                ids2 = [x for _, x in auto2.iter(linesplit[1])]
+            if not ids1 or not ids2:
+                if neighbours:
+                    rescue.append((linesplit, ids1, ids2, weight))
+                elif unmatched is not None:
+                    unmatched.append((unmatched_pair(linesplit, ids1, ids2), weight))
                 continue
-            # this block takes the lion's share of compute time and if optimised would make a big difference
-            if len1 == 1 and len2 == 1:  # both are lists with just one set each
-                idxs = list(matches1[0] & matches2[0])
-            elif len1 == 1:  # matches1 is a list with one set in it
-                idxs = list(matches1[0] & set.union(*matches2))
-            elif len2 == 1:  # matches2 is a list with one set in it
-                idxs = list(matches2[0] & set.union(*matches1))
-            else:  # both lists have multiple sets in them
-                idxs = list(set.union(*matches1) & set.union(*matches2))
-            # end ^^^^^
+            # the guides matching both reads are looked up by their pattern ids instead of intersecting sets
+            idxs = pair_guides(ids1, ids2)
 
             if len(idxs) == 1:
-                output[idxs[0]] += 1
-                unique_matches += 1
+                output[idxs[0]] = output.get(idxs[0], 0) + weight
+                unique_matches += weight
             elif len(idxs) > 1:
-                multi_matches += 1
-                output[idxs] += 1
-                # for loop may be actually faster for small idxs sets
-                # for idx in idxs:
-                #    output[ idx ] += 1
+                multi_matches += weight
+                add_hits(output, idxs, weight)
             else:
-                mismatching_pairs += 1
+                mismatching_pairs += weight
+                if unmatched is not None:
+                    unmatched.append((unmatched_pair(linesplit, ids1, ids2), weight))
                 continue
         else:  # not dual guide
-            idxs = [*(y for _, x in auto.iter(line.strip()) for y in x)]
+            seq = line.strip()
+            ids = lookup_guides(seq, guide_slots, guide_lookup)
+            if not ids:
+                ids = [x for _, x in auto.iter(seq)]
+                if not ids and neighbours:
+                    rescue.append((seq, weight))
+                    continue
+            if not ids:
+                if unmatched is not None:
+                    unmatched.append((seq, weight))
+                continue
+            if len(ids) == 1:
+                start = starts[ids[0]]
+                if starts[ids[0] + 1] - start == 1:  # the common case: one read, one guide
+                    guide = guides[start]
+                    output[guide] = output.get(guide, 0) + weight
+                    unique_matches += weight
+                    continue
+                idxs = guides[start:starts[ids[0] + 1]]
+            else:
+                idxs = [y for x in ids for y in guides_of(x)]
+            if len(idxs) == 1:
+                output[idxs[0]] = output.get(idxs[0], 0) + weight
+                unique_matches += weight
+            elif len(idxs) > 1:
+                multi_matches += weight
+                add_hits(output, idxs, weight)
+    rescued_matches, rescued_mismatching_pairs = rescue_reads(rescue, is_dual_guide, output, unmatched)
+    result = {"output": sparse_counts(output), "multi_matches": multi_matches, "unique_matches": unique_matches,
+              "mismatching_pairs": mismatching_pairs + rescued_mismatching_pairs, "rescued_matches": rescued_matches}
+    if unmatched is not None:
+        result["unmatched"] = summarise_unmatched(unmatched, input["unmatched_size"])
+    return result
+
+
+def rescue_reads(rescue, is_dual_guide, output, unmatched=None):
+    """
+    Matches the reads without an exact match allowing one mismatch, see neighbour_ids. The windows of all the reads
+    are matched against the mismatch index at once.
+    :param rescue: list of (sequence, weight) for single guides, or (sequences, pattern ids found in the first read,
+    pattern ids found in the second read, weight) for dual guides
+    :param is_dual_guide: the library contains dual guides
+    :param output: dictionary of guide indices to the counts of the block the rescued reads are added to
+    :param unmatched: list the reads that are not rescued are added to, see summarise_unmatched
+    :return: the number of rescued reads and the number of mismatching pairs among them
+    """
+    rescued_matches = 0
+    mismatching_pairs = 0
+    if rescue and is_dual_guide:
+        found1 = iter(neighbour_ids([linesplit[0] for linesplit, ids1, _, _ in rescue if not ids1], neighbours))
+        found2 = iter(neighbour_ids([linesplit[1] for linesplit, _, ids2, _ in rescue if not ids2], neighbours2))
+        for linesplit, ids1, ids2, weight in rescue:
+            ids1 = ids1 or next(found1)
+            ids2 = ids2 or next(found2)
+            idxs = pair_guides(ids1, ids2) if ids1 and ids2 else []
+            if idxs:
+                add_hits(output, idxs, weight)
+                rescued_matches += weight
+                continue
+            if ids1 and ids2:
+                mismatching_pairs += weight
+            if unmatched is not None:
+                unmatched.append((unmatched_pair(linesplit, ids1, ids2), weight))
+    elif rescue:
+        for (seq, weight), ids in zip(rescue, neighbour_ids([seq for seq, _ in rescue], neighbours)):
+            idxs = {y for x in ids for y in guides_of(x)}
+            if idxs:
+                add_hits(output, idxs, weight)
+                rescued_matches += weight
+            elif unmatched is not None:
+                unmatched.append((seq, weight))
+    return rescued_matches, mismatching_pairs
+
+
+def exec_kmer_search(**input):
+    """
+    Counts the guides in a block of reads like exec_fragment_search, but matches the 2-bit encoded windows of all
+    reads of the block at once against the sorted guide sequences (--engine numpy). Takes the same arguments, except
+    the guide positions, and gives the same results.
+    """
+    lines = input["data_lines"]
+    weights = input.get("weights")
+    weights = np.ones(len(lines), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+    is_dual_guide = input["is_dual_guide"]
+    num_guides = input["num_guides"]
+    guide_starts, guide_indices = guide_arrays
+    # counts of single reads, and (guide indices, counts) arrays of the counts of all reads at once
+    output = {}
+    arrays = []
+    rescue = []
+    unmatched = [] if input.get("unmatched_size") else None
+    if is_dual_guide:
+        dual_guide_seq_sep = input["dual_guide_seq_sep"]
+        pairs = [line if isinstance(line, tuple) else line.strip().split(dual_guide_seq_sep) for line in lines]
+        owners1, ids1 = kmer_hits([pair[0] for pair in pairs], kmers)
+        owners2, ids2 = kmer_hits([pair[1] if len(pair) > 1 else "" for pair in pairs], kmers2)
+        hits1 = np.bincount(owners1, minlength=len(lines))
+        hits2 = np.bincount(owners2, minlength=len(lines))
+        # pairs with one guide in each read are looked up in the pair table at once
+        single = (hits1 == 1) & (hits2 == 1)
+        first1 = np.zeros(len(lines), dtype=np.int64)
+        first1[owners1] = ids1
+        first2 = np.zeros(len(lines), dtype=np.int64)
+        first2[owners2] = ids2
+        reads = np.flatnonzero(single)
+        pair_keys, pair_starts, pair_indices = pair_arrays
+        keys = first1[reads] * pair_stride + first2[reads]
+        positions = np.minimum(np.searchsorted(pair_keys, keys), len(pair_keys) - 1)
+        found = pair_keys[positions] == keys
+        counts = np.where(found, pair_starts[positions + 1] - pair_starts[positions], 0)
+        unique_matches = int(weights[reads[counts == 1]].sum())
+        multi_matches = int(weights[reads[counts > 1]].sum())
+        mismatching_pairs = int(weights[reads[counts == 0]].sum())
+        if unmatched is not None:
+            mismatching = reads[counts == 0]
+            unmatched += [(((id1,), (id2,)), weight) for id1, id2, weight in
+                          zip(first1[mismatching].tolist(), first2[mismatching].tolist(),
+                              weights[mismatching].tolist())]
+        guides, origins = expand(pair_starts, pair_indices, positions, counts)
+        arrays.append((guides, weights[reads[origins]]))
+        # reads with several guides, or reads to rescue, go through the pair lookup of the automaton engine
+        others = (hits1 > 0) & (hits2 > 0) & ~single
+        if neighbours or unmatched is not None:
+            others |= (hits1 == 0) | (hits2 == 0)
+        found1 = {read: [] for read in np.flatnonzero(others).tolist()}
+        found2 = {read: [] for read in found1}
+        for read, pattern_id in zip(owners1[others[owners1]].tolist(), ids1[others[owners1]].tolist()):
+            found1[read].append(pattern_id)
+        for read, pattern_id in zip(owners2[others[owners2]].tolist(), ids2[others[owners2]].tolist()):
+            found2[read].append(pattern_id)
+        for read in found1:
+            weight = int(weights[read])
+            if not found1[read] or not found2[read]:
+                if neighbours:
+                    rescue.append((pairs[read], found1[read], found2[read], weight))
+                else:
+                    unmatched.append((unmatched_pair(pairs[read], found1[read], found2[read]), weight))
+                continue
+            idxs = pair_guides(found1[read], found2[read])
             if len(idxs) == 1:
-                output[idxs[0]] += 1
-                unique_matches += 1
+                unique_matches += weight
             elif len(idxs) > 1:
-                multi_matches += 1
-                output[idxs] += 1
-    return {"output": output, "multi_matches": multi_matches,
-            "unique_matches": unique_matches, "mismatching_pairs": mismatching_pairs}
+                multi_matches += weight
+            else:
+                mismatching_pairs += weight
+                if unmatched is not None:
+                    unmatched.append((unmatched_pair(pairs[read], found1[read], found2[read]), weight))
+            add_hits(output, idxs, weight)
+    else:  # not dual guide
+        seqs = [line.strip() for line in lines]
+        owners, ids = kmer_hits(seqs, kmers)
+        # a read matching a guide sequence more than once counts as a multi match, like with the automatons
+        matches = np.bincount(owners, weights=guide_starts[ids + 1] - guide_starts[ids], minlength=len(lines))
+        unique_matches = int(weights[matches == 1].sum())
+        multi_matches = int(weights[matches > 1].sum())
+        mismatching_pairs = 0
+        guides, origins = expand(guide_starts, guide_indices, ids)
+        # each guide is counted once per read
+        read_guides = np.unique(owners[origins] * num_guides + guides)
+        arrays.append((read_guides % num_guides, weights[read_guides // num_guides]))
+        if neighbours:
+            rescue = [(seqs[read], int(weights[read])) for read in np.flatnonzero(matches == 0).tolist()]
+        elif unmatched is not None:
+            unmatched = [(seqs[read], int(weights[read])) for read in np.flatnonzero(matches == 0).tolist()]
+    rescued_matches, rescued_mismatching_pairs = rescue_reads(rescue, is_dual_guide, output, unmatched)
+    result = {"output": sparse_counts(output, arrays), "multi_matches": multi_matches, "unique_matches": unique_matches,
+              "mismatching_pairs": mismatching_pairs + rescued_mismatching_pairs, "rescued_matches": rescued_matches}
+    if unmatched is not None:
+        result["unmatched"] = summarise_unmatched(unmatched, input["unmatched_size"])
+    return result
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    if sys.argv[1:2] == ["build-index"]:
+        build_index_main(sys.argv[2:])
+        sys.exit()
+    if sys.argv[1:2] == ["merge"]:
+        merge_main(sys.argv[2:])
+        sys.exit()
     parser = argparse.ArgumentParser(description='Count instances of CRISPR guides in input nucleotide sequences.', prog='count.py')
     # Library
     parser.add_argument('--lib', help='Filename of an input library.', required=True)
     parser.add_argument('--dual_guide', help='Library contains dual guides.', action="store_true")
     # Sequences
     parser.add_argument('--dual_guide_seq_sep', help='Delimiter for sequencing read 1 and 2 when using dual guide libraries [default: tab].', default="\t")
-    parser.add_argument('--input', help='Input sequence file name or - for stdin with one nucleotide sequence per line. For dual guides the sequences must be separated with dual_guide_seq_sep.', required=True)
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', help='Input sequence file name or - for stdin with one nucleotide sequence per line. For dual guides the sequences must be separated with dual_guide_seq_sep.')
+    inputs.add_argument('--fastq', help='Input FASTQ file name (.fq or .fq.gz) for single guide libraries.')
+    inputs.add_argument('--r1', help='Read 1 FASTQ file name (.fq or .fq.gz) for dual guide libraries, use with --r2.')
+    inputs.add_argument('--samples', help='Tab delimited sample sheet for counting several samples in one run, with'
+                                          ' a header line and the columns sample and input, fastq or r1 and r2.'
+                                          ' The output is then a matrix with a count column per sample.')
+    parser.add_argument('--r2', help='Read 2 FASTQ file name (.fq or .fq.gz) for dual guide libraries, use with --r1.')
+    parser.add_argument('--barcodes', help='Tab delimited barcode sheet for counting the samples of a multiplexed'
+                                           ' input in one pass, with a header line and the columns sample and'
+                                           ' barcode, and optionally position (0-based, default 0) and read (R1,'
+                                           ' R2 or I1, default R1). The output is a matrix with a count column per'
+                                           ' sample and one for the unassigned reads.')
+    parser.add_argument('--index_fastq', help='Index read FASTQ file name for --barcodes in read I1.')
+    parser.add_argument('--decompress_threads', help='Number of threads for decompressing gzipped FASTQ files;'
+                                                     ' BGZF files are decompressed block parallel [default: 2].',
+                        default=2)
+    parser.add_argument('--shard', help='Count only shard i of N of the input, given as i/N, and write partial counts'
+                                        ' to --out for count.py merge. An --input file is split into N byte ranges'
+                                        ' (it must be a plain or BGZF compressed file, not a pipe); --fastq and'
+                                        ' --r1/--r2 reads are dealt to the shards in blocks of --block_size reads,'
+                                        ' so all shards must use the same --block_size.', type=parse_shard)
     # Processing
     parser.add_argument('--processes', help='Number of processes to use [default: 1].', default=1)
     parser.add_argument('--block_size', help='Block size for processing given in number of sequencing'
-                                             ' reads [default: 25000].', default=25000)
+                                             ' reads [default: 25000].', default=default_block_size)
+    parser.add_argument('--autotune', help='Adjust the number of busy worker processes and the block size while'
+                                           ' counting, from the throughput of the reader and of the workers measured'
+                                           ' every few seconds. The pool has a worker per CPU this process may use,'
+                                           ' capped by the CPU quota of its cgroup, instead of --processes;'
+                                           ' --block_size is the initial block size. --collapse, --guide_offset auto'
+                                           ' and shards of BGZF files keep --block_size.', action="store_true")
     parser.add_argument('--no_rev_comp', help='Do not count reverse complements additionally.', action="store_true")
+    parser.add_argument('--orientation', help='Orientation the guides are matched in: forward, reverse complement,'
+                                              ' both, or auto to count the first --orientation_sample_size reads of'
+                                              ' each sample in both orientations and match the guides only in'
+                                              ' forward or only in reverse complement orientation if hardly any of'
+                                              ' these reads have a guide in the other one (separately for R1 and R2'
+                                              ' with dual guides) [default: both].',
+                        choices=["both", "forward", "reverse", "auto"], default="both")
+    parser.add_argument('--orientation_sample_size', help='Number of reads per sample used by --orientation auto'
+                                                          ' [default: 10000].', default=10000)
+    parser.add_argument('--engine', help='Guide matching engine: aho-corasick searches each read with the automatons,'
+                                         ' numpy matches all windows of a block of reads at once against the sorted'
+                                         ' guide sequences, which needs guides of up to 32 bases of ACGT only.'
+                                         ' Both give the same counts [default: aho-corasick].',
+                        choices=["aho-corasick", "numpy"], default="aho-corasick")
+    parser.add_argument('--collapse', help='Match identical reads (or read pairs) only once and count them by their'
+                                           ' multiplicity; useful for redundant samples, eg plasmid libraries.',
+                        action="store_true")
+    parser.add_argument('--collapse_limit', help='Maximum number of distinct reads held in memory by --collapse'
+                                                 ' [default: 1000000].', default=1000000)
+    parser.add_argument('--index_dir', help='Directory of compiled library indexes. The library is compiled into it'
+                                            ' on first use (or with count.py build-index) and loaded from it on later'
+                                            ' runs [default: compile the library on every run].')
+    parser.add_argument('--max_mismatches', help='Maximum number of mismatches between a guide and a read, 0 or 1.'
+                                                 ' With 1, reads without an exact match are matched again allowing'
+                                                 ' one mismatch per read, unless that is ambiguous, and counted as'
+                                                 ' rescued matches [default: 0].', default=0)
+    parser.add_argument('--guide_offset', help='Position of the guides in the reads (0-based), or auto to detect the'
+                                               ' dominant position per orientation from the first reads. Guides are'
+                                               ' looked up at this position first, and only reads without a guide'
+                                               ' there are searched in full [default: search the whole read].')
+    parser.add_argument('--guide_length', help='Length of the guides at --guide_offset [default: most common guide'
+                                               ' length in the library].')
+    parser.add_argument('--offset_sample_size', help='Number of reads used by --guide_offset auto'
+                                                     ' [default: 10000].', default=10000)
+    parser.add_argument('--preview', help='Count a subsample of each sample for a quick look: the fraction of reads'
+                                          ' with a match, with several matches and with mismatching guides, the Gini'
+                                          ' index of the counts and the fraction of guides without a count are'
+                                          ' logged with 95%% intervals every --preview_interval reads, and counting'
+                                          ' the sample stops once they have converged within --preview_tolerance or'
+                                          ' at --max_reads. The counts are provisional, and scaled up by'
+                                          ' --preview_every.', action="store_true")
+    parser.add_argument('--preview_every', help='Count every nth read with --preview [default: 1].', default=1)
+    parser.add_argument('--preview_interval', help='Number of counted reads between --preview estimates'
+                                                   ' [default: 100000].', default=100000)
+    parser.add_argument('--preview_tolerance', help='Largest half width of the intervals of the --preview estimates'
+                                                    ' and change between two estimates for them to have converged'
+                                                    ' [default: 0.005].', default=0.005)
+    parser.add_argument('--max_reads', help='Stop counting a sample after this many counted reads with --preview.')
+    parser.add_argument('--checkpoint', help='Checkpoint file the counts so far are saved to every'
+                                             ' --checkpoint_reads reads or --checkpoint_seconds seconds, and removed'
+                                             ' from once the run is complete.')
+    parser.add_argument('--checkpoint_reads', help='Number of reads between checkpoints [default: 10000000].',
+                        default=10000000)
+    parser.add_argument('--checkpoint_seconds', help='Number of seconds between checkpoints [default: 600].',
+                        default=600)
+    parser.add_argument('--resume', help='Continue from the --checkpoint of an interrupted run with the same library,'
+                                         ' input and settings, skipping the reads already counted; without a'
+                                         ' checkpoint file the run starts from the beginning.', action="store_true")
     # Output
     parser.add_argument('--out', help='Output text file name. - does not mean stdout.', required=True)
+    parser.add_argument('--summary', help='Output text file name for the number of reads and the match counters of'
+                                          ' each sample.')
+    parser.add_argument('--unmatched', help='Output text file name for the most frequent reads without a match in each'
+                                            ' sample, or for dual guides the guides found in each read of the'
+                                            ' mismatching pairs.')
+    parser.add_argument('--unmatched_top', help='Number of unmatched reads reported per sample by --unmatched'
+                                                ' [default: 100].', default=100)
 
+    parser.add_argument('--stats_json', help='Output JSON file for the wall clock and CPU time of each phase of the'
+                                             ' run, the throughput over time, the busy and idle time of each worker,'
+                                             ' the time spent waiting for input and for the workers, the queue'
+                                             ' depth, the peak memory use and the match counters.')
     parser.add_argument('--version', help='Output program name and version number.', action='version', version=f'%(prog)s {version}')
     args = parser.parse_args()
+    if bool(args.r1) != bool(args.r2):
+        parser.error('--r1 and --r2 must be given together')
+    if args.r1 and not args.dual_guide:
+        parser.error('--r1 and --r2 require --dual_guide')
+    if args.fastq and args.dual_guide:
+        parser.error('--dual_guide requires --r1 and --r2 instead of --fastq')
+    if args.engine == "numpy" and args.guide_offset is not None:
+        parser.error('--guide_offset applies to --engine aho-corasick only')
+    if args.shard and args.samples:
+        parser.error('--shard applies to a single --input, --fastq or --r1 and --r2')
+    if args.shard and args.input and not os.path.isfile(args.input):
+        parser.error('--shard needs a seekable --input file')
+    if args.barcodes and (args.samples or args.shard):
+        parser.error('--barcodes applies to a single --input, --fastq or --r1 and --r2 without --shard')
+    if args.index_fastq and not (args.barcodes and (args.fastq or args.r1)):
+        parser.error('--index_fastq requires --barcodes and --fastq or --r1 and --r2')
+    if args.no_rev_comp and args.orientation != "both":
+        parser.error('--no_rev_comp is the same as --orientation forward, give only one of them')
+    if args.orientation == "auto" and args.input and not os.path.isfile(args.input):
+        parser.error('--orientation auto needs an --input file, not a pipe')
+    if args.autotune and args.shard and not args.input:
+        parser.error('--shard of FASTQ reads needs the same --block_size in all shards, not --autotune')
+    if args.preview and (args.shard or args.checkpoint or args.barcodes):
+        parser.error('--preview applies to whole samples without --shard, --checkpoint or --barcodes')
+    if (args.max_reads or args.preview_every != 1) and not args.preview:
+        parser.error('--max_reads and --preview_every require --preview')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    if args.max_mismatches not in (0, '0', '1'):
+        parser.error('--max_mismatches must be 0 or 1')
     main(args)
@@ -60,5 +60,50 @@ class TestCount(unittest.TestCase):
         self.assertEqual(3, total_matches, "Total matches not as expected")
 
 
+class TestGuideCounter(unittest.TestCase):
+    """
+    Counting in process with the GuideCounter class.
+    """
+
+    def test_single_guide(self):
+        """
+        Test case for counting single guide reads in batches, and merging counters.
+        """
+        import count
+        reads = list(count.read_fastq(
+            "test-data/test-single-guide-count/SLX-19443.i701_i503.HK3H3BBXY.s_6.r_1.sample.fq.gz"))
+        counter = count.GuideCounter("test-data/test-single-guide-count/test-lib-plasmid-nf-core-2.tsv")
+        counter.update(reads[:50]).update(reads[50:])
+        result = counter.result()
+        self.assertEqual(119, result["reads"])
+        self.assertEqual(119, result["unique_matches"])
+        self.assertEqual(119, result["output"].sum())
+        other = count.GuideCounter("test-data/test-single-guide-count/test-lib-plasmid-nf-core-2.tsv",
+                                   engine="numpy")
+        other.update(reads)
+        self.assertEqual(238, counter.merge(other).result()["output"].sum())
+
+    def test_dual_guide_records(self):
+        """
+        Test case for counting read pairs with a library given as records.
+        """
+        import count
+        library = pd.read_csv("test-data/test-dual-guide-count/test-dual-guide-annot-library--cleanr.tsv", sep="\t")
+        path = "test-data/test-dual-guide-count/test-dual-guide-sample--SLX-20701.i714_i511.000000000-JVMBF.s_1.r_"
+        counter = count.GuideCounter(library.to_dict("records"), dual_guide=True)
+        counter.update_pairs(count.read_fastq(path + "1.fq.gz"), count.read_fastq(path + "2.fq.gz"))
+        result = counter.result()
+        self.assertEqual([165, 89, 0, 41], [result[key] for key in ["reads", "unique_matches", "multi_matches",
+                                                                    "mismatching_pairs"]])
+        with self.assertRaises(ValueError):
+            counter.merge(count.GuideCounter("test-data/test-single-guide-count/test-lib-plasmid-nf-core-2.tsv"))
+        with self.assertRaises(ValueError):
+            counter.merge(count.GuideCounter(library.to_dict("records"), dual_guide=True, count_revcomp=False))
+        with self.assertRaises(ValueError):
+            counter.merge(count.GuideCounter(library.to_dict("records"), dual_guide=True, max_mismatches=1))
+        same = count.GuideCounter(library.to_dict("records"), dual_guide=True)
+        self.assertEqual(165, counter.merge(same).result()["reads"])
+
+
 if __name__ == "__main__":
     unittest.main()